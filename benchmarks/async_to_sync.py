@@ -0,0 +1,29 @@
+# SPDX-FileCopyrightText: 2023 Magenta ApS <https://magenta.dk>
+# SPDX-License-Identifier: MPL-2.0
+"""Compare per-call overhead of `async_to_sync` with and without a persistent loop.
+
+Run with:
+    python -m benchmarks.async_to_sync
+"""
+import asyncio
+from timeit import repeat
+
+from ra_utils.async_to_sync import async_to_sync
+
+
+async def noop() -> None:
+    await asyncio.sleep(0)
+
+
+def main(number: int = 1000, repetitions: int = 5) -> None:
+    candidates = {
+        "asyncio.run": async_to_sync(noop),
+        "persistent": async_to_sync(persistent=True)(noop),
+    }
+    for name, func in candidates.items():
+        best = min(repeat(func, number=number, repeat=repetitions))
+        print(f"{name:>12}: {best / number * 1e6:8.1f} us per call")
+
+
+if __name__ == "__main__":
+    main()
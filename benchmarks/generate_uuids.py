@@ -0,0 +1,39 @@
+# SPDX-FileCopyrightText: 2023 Magenta ApS <https://magenta.dk>
+# SPDX-License-Identifier: MPL-2.0
+"""Compare bulk UUID generation against calling `generate_uuid` per value.
+
+Run with:
+    python -m benchmarks.generate_uuids
+"""
+from time import perf_counter
+from typing import List
+
+from ra_utils.generate_uuid import _generate_uuid
+from ra_utils.generate_uuid import generate_uuid
+from ra_utils.generate_uuid import generate_uuid_bytes
+from ra_utils.generate_uuid import generate_uuids
+
+
+def main(count: int = 1000000) -> None:
+    values = [f"row{i}" for i in range(count)]
+    candidates = {
+        "per-call loop": lambda: [generate_uuid("base", value) for value in values],
+        "generate_uuids": lambda: list(generate_uuids("base", values)),
+        "processes": lambda: list(
+            generate_uuids("base", values, processes=True, chunksize=50000)
+        ),
+        "bytes": lambda: generate_uuid_bytes("base", values),
+    }
+    timings: List[float] = []
+    for name, func in candidates.items():
+        _generate_uuid.cache_clear()
+        start = perf_counter()
+        func()
+        elapsed = perf_counter() - start
+        timings.append(elapsed)
+        print(f"{name:>15}: {elapsed:6.2f} s, {elapsed / count * 1e9:6.0f} ns per UUID")
+    print(f"{'speedup':>15}: {timings[0] / min(timings[1:]):6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+# SPDX-FileCopyrightText: 2023 Magenta ApS <https://magenta.dk>
+# SPDX-License-Identifier: MPL-2.0
+"""Measure attribute access and method call overhead on `Syncable` instances.
+
+Run with:
+    python -m benchmarks.syncable
+"""
+from timeit import repeat
+
+from ra_utils.syncable import Syncable
+
+
+class AsyncCounter:
+    value = 0
+
+    async def increment(self) -> int:
+        self.value += 1
+        return self.value
+
+
+class Counter(Syncable, AsyncCounter):
+    pass
+
+
+def main(number: int = 100000, repetitions: int = 5) -> None:
+    async_counter = AsyncCounter()
+    counter = Counter()
+    candidates = {
+        "plain attribute": lambda: async_counter.value,
+        "syncable attribute": lambda: counter.value,
+        "syncable lookup": lambda: counter.increment,
+    }
+    for name, func in candidates.items():
+        best = min(repeat(func, number=number, repeat=repetitions))
+        print(f"{name:>20}: {best / number * 1e9:8.1f} ns per access")
+
+    number //= 10
+    best = min(repeat(counter.increment, number=number, repeat=repetitions))
+    print(f"{'syncable call':>20}: {best / number * 1e6:8.1f} us per call")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+# SPDX-FileCopyrightText: 2023 Magenta ApS <https://magenta.dk>
+# SPDX-License-Identifier: MPL-2.0
+"""Compare the default event-loop with uvloop on a local socket echo workload.
+
+Run with:
+    python -m benchmarks.uvloop_echo
+"""
+import asyncio
+from time import perf_counter
+
+from ra_utils.async_to_sync import async_to_sync
+
+MESSAGE = b"x" * 100 + b"\n"
+
+
+async def handle_echo(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    while line := await reader.readline():
+        writer.write(line)
+        await writer.drain()
+    writer.close()
+
+
+async def client(port: int, messages: int) -> None:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    for _ in range(messages):
+        writer.write(MESSAGE)
+        await writer.drain()
+        await reader.readline()
+    writer.close()
+    await writer.wait_closed()
+
+
+async def echo_workload(clients: int, messages: int) -> float:
+    server = await asyncio.start_server(handle_echo, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    async with server:
+        start = perf_counter()
+        await asyncio.gather(*(client(port, messages) for _ in range(clients)))
+        return perf_counter() - start
+
+
+def main(clients: int = 50, messages: int = 1000) -> None:
+    total = clients * messages
+    for name, use_uvloop in (("asyncio", False), ("uvloop", True)):
+        elapsed = async_to_sync(use_uvloop=use_uvloop)(echo_workload)(clients, messages)
+        print(f"{name:>8}: {total / elapsed:10.0f} round-trips per second")
+
+
+if __name__ == "__main__":
+    main()
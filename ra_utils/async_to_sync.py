@@ -1,21 +1,285 @@
 # SPDX-FileCopyrightText: 2021 Magenta ApS <https://magenta.dk>
 # SPDX-License-Identifier: MPL-2.0
 import asyncio
+import atexit
+import os
+from asyncio import AbstractEventLoop
+from asyncio import get_running_loop
+from asyncio import new_event_loop
+from asyncio import run_coroutine_threadsafe
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
+from threading import get_ident
+from threading import Lock
+from threading import Thread
 from typing import Any
 from typing import Awaitable
 from typing import Callable
+from typing import cast
+from typing import Coroutine
 from typing import Optional
+from typing import overload
 from typing import TypeVar
+from typing import Union
+
+_has_uvloop = True
+try:
+    import uvloop
+except ImportError:  # pragma: no cover
+    _has_uvloop = False
 
 CallableReturnType = TypeVar("CallableReturnType")
+AsyncFunction = Callable[..., Awaitable[CallableReturnType]]
+SyncFunction = Callable[..., CallableReturnType]
+_TRUTHY = ("1", "true", "yes", "on")
+
+
+def uvloop_enabled(use_uvloop: Optional[bool] = None) -> bool:
+    """Check whether event-loops should be created using uvloop.
+
+    Args:
+        use_uvloop: Whether to use uvloop, or `None` to read the `RA_UTILS_UVLOOP`
+            environment variable.
+
+    Returns:
+        Whether uvloop was requested and is installed.
+    """
+    if use_uvloop is None:
+        use_uvloop = os.environ.get("RA_UTILS_UVLOOP", "").lower() in _TRUTHY
+    return use_uvloop and _has_uvloop
+
+
+def create_event_loop(use_uvloop: Optional[bool] = None) -> AbstractEventLoop:
+    """Create a new event-loop, using uvloop if requested and installed.
+
+    Example:
+        ```Python
+        loop = create_event_loop(use_uvloop=True)
+        print(type(loop))  # --> uvloop.Loop, if uvloop is installed
+        ```
+
+    Args:
+        use_uvloop: Whether to use uvloop, or `None` to enable it through the
+            `RA_UTILS_UVLOOP` environment variable. Falls back silently to the
+            default event-loop if uvloop is not installed.
+
+    Returns:
+        The new event-loop.
+    """
+    if uvloop_enabled(use_uvloop):
+        return cast(AbstractEventLoop, uvloop.new_event_loop())
+    return new_event_loop()
+
+
+def run(
+    coroutine: Coroutine[Any, Any, CallableReturnType],
+    use_uvloop: Optional[bool] = None,
+) -> CallableReturnType:
+    """Like `asyncio.run`, but using uvloop if requested and installed.
+
+    Args:
+        coroutine: The coroutine to run.
+        use_uvloop: Whether to use uvloop, as for `create_event_loop`.
+
+    Returns:
+        The result of the coroutine.
+    """
+    if not uvloop_enabled(use_uvloop):
+        return asyncio.run(coroutine)
+    loop = create_event_loop(use_uvloop)
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(coroutine)
+    finally:
+        try:
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+
+def _run_in_new_thread(
+    coroutine: Coroutine[Any, Any, CallableReturnType]
+) -> CallableReturnType:
+    """Run a coroutine in a new event-loop, on a temporary thread.
+
+    Args:
+        coroutine: The coroutine to run.
+
+    Returns:
+        The result of the coroutine.
+    """
+    with ThreadPoolExecutor(1) as executor:
+        return executor.submit(run, coroutine).result()
+
+
+def _in_running_loop() -> bool:
+    """Check whether an event-loop is running in the current thread.
 
+    Returns:
+        Whether an event-loop is running.
+    """
+    try:
+        get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+async def _shutdown() -> None:
+    """Cancel and await the other tasks of the running loop, as done by `run`."""
+    current = asyncio.current_task()
+    tasks = [task for task in asyncio.all_tasks() if task is not current]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await get_running_loop().shutdown_asyncgens()
+
+
+class EventLoopThread:
+    """Long-lived event-loop running on a dedicated daemon thread.
+
+    The loop and thread are started on first use, and restarted in child
+    processes after a fork. Coroutines submitted from any thread run on the same
+    loop, so connection pools and other loop-bound resources survive between
+    calls.
+
+    Example:
+        ```Python
+        runner = EventLoopThread()
+        print(runner.run(asyncio.sleep(1, result=5)))  # --> 5
+        runner.stop()
+        ```
+
+    Args:
+        name: Name of the thread running the loop.
+        use_uvloop: Whether to use uvloop, as for `create_event_loop`.
+    """
+
+    def __init__(
+        self, name: str = "ra_utils-event-loop", use_uvloop: Optional[bool] = None
+    ) -> None:
+        self.name = name
+        self.use_uvloop = use_uvloop
+        self._lock = Lock()
+        self._loop: Optional[AbstractEventLoop] = None
+        self._thread: Optional[Thread] = None
+        self._pid: Optional[int] = None
+        self._blocked = 0
+
+    @property
+    def loop(self) -> AbstractEventLoop:
+        """The event-loop, started on first access."""
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                loop = create_event_loop(self.use_uvloop)
+                thread = Thread(target=loop.run_forever, name=self.name, daemon=True)
+                thread.start()
+                self._loop, self._thread, self._pid = loop, thread, os.getpid()
+                self._blocked = 0
+            return self._loop
+
+    def run(
+        self, coroutine: Coroutine[Any, Any, CallableReturnType]
+    ) -> CallableReturnType:
+        """Run a coroutine to completion on the loop, blocking until it is done.
+
+        If called from the loop thread itself, which would deadlock, the coroutine
+        is instead run in a new event-loop on a temporary thread, as are calls made
+        while the loop is blocked like that.
 
+        Args:
+            coroutine: The coroutine to run.
+
+        Returns:
+            The result of the coroutine.
+        """
+        loop = self.loop
+        if self._thread is not None and self._thread.ident == get_ident():
+            # The loop is blocked until we return, so calls made in the meantime,
+            # including from the coroutine itself, must not wait for it either
+            with self._lock:
+                self._blocked += 1
+            try:
+                return _run_in_new_thread(coroutine)
+            finally:
+                with self._lock:
+                    self._blocked -= 1
+        if self._blocked:
+            return _run_in_new_thread(coroutine)
+        future = run_coroutine_threadsafe(coroutine, loop)
+        try:
+            return future.result()
+        except BaseException:
+            # Interrupted while waiting, do not leave the coroutine running
+            future.cancel()
+            raise
+
+    def stop(self) -> None:
+        """Stop and close the loop, if running in this process.
+
+        Pending tasks are cancelled and awaited before the loop is closed. If
+        called from the loop thread itself, the loop is only stopped.
+        """
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            if loop is None or thread is None or self._pid != os.getpid():
+                return
+            self._loop = self._thread = self._pid = None
+        if thread.ident == get_ident():
+            # Called from the loop itself, which cannot wait for itself to stop
+            loop.call_soon(loop.stop)
+            return
+        run_coroutine_threadsafe(_shutdown(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+# Process-wide event-loop used by `async_to_sync(persistent=True)`
+background_loop = EventLoopThread()
+atexit.register(background_loop.stop)
+
+
+@overload
 def async_to_sync(
-    func: Callable[..., Awaitable[CallableReturnType]]
-) -> Callable[..., CallableReturnType]:
+    func: AsyncFunction[CallableReturnType],
+) -> SyncFunction[CallableReturnType]:
+    ...  # pragma: no cover
+
+
+@overload
+def async_to_sync(
+    *, persistent: bool = False, use_uvloop: Optional[bool] = None
+) -> Callable[[AsyncFunction[CallableReturnType]], SyncFunction[CallableReturnType]]:
+    ...  # pragma: no cover
+
+
+def async_to_sync(
+    func: Optional[AsyncFunction[CallableReturnType]] = None,
+    *,
+    persistent: bool = False,
+    use_uvloop: Optional[bool] = None,
+) -> Union[
+    SyncFunction[CallableReturnType],
+    Callable[[AsyncFunction[CallableReturnType]], SyncFunction[CallableReturnType]],
+]:
     """Function decorator to run an async function to completion.
 
+    By default, every call runs in a new event-loop using `asyncio.run`. With
+    `persistent` set, every call instead runs on the process-wide
+    `background_loop`, avoiding the cost of setting up a new loop per call, and
+    allowing connection pools and clients bound to the loop to be reused.
+
+    If called from within a running event-loop, such as in Jupyter or from a sync
+    library called by async code, where `asyncio.run` would fail, the call is
+    always run on the `background_loop`. Note that the calling loop is blocked
+    until the call finishes, as with any other blocking call.
+
     Example:
         ```Python
         @async_to_sync
@@ -24,17 +288,37 @@ def async_to_sync(
             return seconds
 
         print(sleepy(5))  # --> 5
+
+        @async_to_sync(persistent=True)
+        async def fetch(url):
+            return await client.get(url)  # client is reused between calls
         ```
 
     Args:
         func: The asynchronous function to wrap.
+        persistent: Whether to run on the long-lived background event-loop.
+        use_uvloop: Whether to create per-call event-loops using uvloop, or `None`
+            to enable it through the `RA_UTILS_UVLOOP` environment variable.
+            Falls back silently to the default event-loop if uvloop is not
+            installed. The background event-loop is configured through the
+            environment variable only.
 
     Returns:
-        The newly generated synchronous function wrapping the async one.
+        The newly generated synchronous function wrapping the async one, or a
+        decorator creating it, if no function is given.
     """
 
-    @wraps(func)
-    def wrapper(*args: Any, **kwargs: Optional[Any]) -> CallableReturnType:
-        return asyncio.run(func(*args, **kwargs))  # type: ignore
+    def decorator(
+        func: AsyncFunction[CallableReturnType],
+    ) -> SyncFunction[CallableReturnType]:
+        @wraps(func)
+        def wrapper(*args: Any, **kwargs: Optional[Any]) -> CallableReturnType:
+            if persistent or _in_running_loop():
+                return background_loop.run(func(*args, **kwargs))  # type: ignore
+            return run(func(*args, **kwargs), use_uvloop)  # type: ignore
+
+        return wrapper
 
-    return wrapper
+    if func is None:
+        return decorator
+    return decorator(func)
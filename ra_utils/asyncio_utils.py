@@ -1,25 +1,270 @@
 # SPDX-FileCopyrightText: 2021 Magenta ApS <https://magenta.dk>
 # SPDX-License-Identifier: MPL-2.0
+from asyncio import AbstractEventLoop
+from asyncio import CancelledError
+from asyncio import current_task
+from asyncio import ensure_future
+from asyncio import FIRST_COMPLETED
+from asyncio import Future
 from asyncio import gather
+from asyncio import get_running_loop
+from asyncio import Handle
+from asyncio import iscoroutine
+from asyncio import Queue
 from asyncio import Semaphore
+from asyncio import shield
+from asyncio import sleep as asyncio_sleep
+from asyncio import Task
+from asyncio import TimerHandle
+from asyncio import wait
+from asyncio import wait_for
+from collections import defaultdict
+from collections import deque
+from concurrent.futures import Executor
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from dataclasses import field
+from functools import update_wrapper
 from functools import wraps
+from itertools import chain
+from math import inf
+from random import random
+from threading import Lock
+from time import monotonic
 from typing import Any
+from typing import AsyncIterable
+from typing import AsyncIterator
 from typing import Awaitable
 from typing import Callable
 from typing import cast
+from typing import Deque
+from typing import Dict
+from typing import Generic
+from typing import Hashable
+from typing import Iterable
+from typing import Iterator
 from typing import List
+from typing import Mapping
+from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Tuple
+from typing import Type
 from typing import TypeVar
+from typing import Union
+from weakref import WeakKeyDictionary
+
+from more_itertools import chunked
+from prometheus_client import CollectorRegistry
+from prometheus_client import Counter
+from prometheus_client import Gauge
+from prometheus_client import Histogram
+from prometheus_client import REGISTRY
 
 
 ReturnType = TypeVar("ReturnType")
 WithConcurrencyFunction = Callable[..., Awaitable[ReturnType]]
+TaskFactory = Callable[[], Awaitable[ReturnType]]
+KeyFunction = Callable[..., Hashable]
+KeyType = TypeVar("KeyType", bound=Hashable)
+ValueType = TypeVar("ValueType")
+BatchFunction = Callable[
+    [List[KeyType]], Awaitable[Union[Sequence[ValueType], Mapping[KeyType, ValueType]]]
+]
+LoopSemaphores = Dict[Hashable, Tuple[Semaphore, int]]
+
+
+def _validate_parallel(parallel: int) -> None:
+    """Validate a concurrency limit.
+
+    Args:
+        parallel: The number of concurrent tasks being executed.
+
+    Raises:
+        TypeError: if parallel has the wrong type.
+        ValueError: if parallel is not positive.
+    """
+    if not isinstance(parallel, int):
+        raise TypeError(f"parallel must be an int, not {type(parallel).__name__}")
+    if parallel < 1:
+        raise ValueError(f"parallel must be positive, got {parallel}")
+
+
+async def _aiter(
+    iterable: Union[Iterable[ReturnType], AsyncIterable[ReturnType]]
+) -> AsyncIterator[ReturnType]:
+    """Iterate over either a synchronous or an asynchronous iterable.
+
+    Args:
+        iterable: The iterable to iterate over.
+
+    Yields:
+        Elements from the iterable, one at a time.
+    """
+    if isinstance(iterable, AsyncIterable):
+        async for element in iterable:
+            yield element
+    else:
+        for element in iterable:
+            yield element
+
+
+@dataclass
+class _Slot:
+    """A concurrency slot of the current task.
+
+    Attributes:
+        acquire: Coroutine function re-acquiring the slot.
+        release: Function releasing the slot.
+        owner: The task holding the slot. Child tasks inherit the slot along with
+            the context, but must not release it on behalf of their parent.
+        held: Whether the slot is currently held, and thus must be released.
+    """
+
+    acquire: Callable[[], Awaitable[Any]]
+    release: Callable[[], None]
+    owner: Optional["Task[Any]"]
+    held: bool = True
+
+
+# The concurrency slot of the current task, see `released_slot`
+_held_slot: ContextVar[Optional[_Slot]] = ContextVar("held_slot", default=None)
+
+
+@asynccontextmanager
+async def _holding_slot(
+    acquire: Callable[[], Awaitable[Any]], release: Callable[[], None]
+) -> AsyncIterator[_Slot]:
+    """Mark a concurrency slot as held by the current task.
+
+    The slot must be released afterwards only if still `held`, as it is not if
+    the task was cancelled while re-acquiring it in `released_slot`.
+
+    Args:
+        acquire: Coroutine function re-acquiring the slot.
+        release: Function releasing the slot.
+
+    Yields:
+        The slot.
+    """
+    slot = _Slot(acquire, release, current_task())
+    token = _held_slot.set(slot)
+    try:
+        yield slot
+    finally:
+        _held_slot.reset(token)
+
+
+@asynccontextmanager
+async def released_slot() -> AsyncIterator[None]:
+    """Temporarily give back the concurrency slot held by the current task.
+
+    Allows other tasks to run while the current one is waiting on something
+    unrelated to the limited resource, such as backing off before a retry.
+    The slot is re-acquired before the context manager exits, waiting for it to
+    free up if needed. Does nothing if no slot is held by the current task
+    itself, such as in tasks started by the task holding the slot.
+
+    Example:
+        ```Python
+        @with_concurrency(5)
+        async def intensive_task(i: int) -> None:
+            ...
+            async with released_slot():
+                await asyncio.sleep(10)
+            ...
+        ```
+    """
+    slot = _held_slot.get()
+    if slot is None or not slot.held or slot.owner is not current_task():
+        yield
+        return
+    slot.release()
+    slot.held = False
+    try:
+        yield
+    finally:
+        await slot.acquire()
+        slot.held = True
+
+
+class ConcurrencyMetrics:
+    """Prometheus metrics for calls limited by `with_concurrency`.
+
+    Records the following metrics, prefixed with `name`:
+
+    * `_in_flight`: Gauge of calls currently running.
+    * `_waiting`: Gauge of calls currently waiting for a concurrency slot.
+    * `_wait_seconds`: Histogram of time spent waiting for a concurrency slot.
+    * `_run_seconds`: Histogram of time spent running, once a slot was acquired.
+    * `_errors_total`: Counter of calls which raised an exception.
+
+    Example:
+        ```Python
+        metrics = ConcurrencyMetrics("mo_requests")
+
+        @with_concurrency(5, metrics=metrics)
+        async def fetch(url: str) -> bytes:
+            ...
+        ```
+
+    Args:
+        name: Prefix for the metric names.
+        registry: The registry to register the metrics in.
+    """
+
+    def __init__(self, name: str, registry: CollectorRegistry = REGISTRY) -> None:
+        self.in_flight = Gauge(
+            f"{name}_in_flight", "Number of calls currently running", registry=registry
+        )
+        self.waiting = Gauge(
+            f"{name}_waiting",
+            "Number of calls currently waiting for a concurrency slot",
+            registry=registry,
+        )
+        self.wait_seconds = Histogram(
+            f"{name}_wait_seconds",
+            "Time spent waiting for a concurrency slot",
+            registry=registry,
+        )
+        self.run_seconds = Histogram(
+            f"{name}_run_seconds",
+            "Time spent running, after acquiring a concurrency slot",
+            registry=registry,
+        )
+        self.errors = Counter(
+            f"{name}_errors", "Number of calls which raised", registry=registry
+        )
+
+    @contextmanager
+    def track_waiting(self) -> Iterator[None]:
+        """Record time spent waiting for a concurrency slot."""
+        with self.waiting.track_inprogress(), self.wait_seconds.time():
+            yield
+
+    @contextmanager
+    def track_running(self) -> Iterator[None]:
+        """Record time spent running, and whether it raised."""
+        with self.in_flight.track_inprogress(), self.run_seconds.time():
+            with self.errors.count_exceptions():
+                yield
 
 
 def with_concurrency(
     parallel: int,
+    key: Optional[KeyFunction] = None,
+    metrics: Optional[ConcurrencyMetrics] = None,
 ) -> Callable[[WithConcurrencyFunction], WithConcurrencyFunction]:
     """Decorator which limits concurrency.
 
+    The limit applies per running event-loop, and optionally per key, as
+    computed by `key` from the arguments of each call. Semaphores are created
+    lazily on first use within a loop, and dropped along with the loop.
+
     Example:
         ```Python
         @with_concurrency(5)
@@ -33,39 +278,802 @@ def with_concurrency(
         await asyncio.gather(*tasks)
         ```
 
+    Example:
+        Instrumented usage:
+        ```Python
+        @with_concurrency(5, metrics=ConcurrencyMetrics("mo_requests"))
+        async def fetch(url: str) -> bytes:
+            ...
+        ```
+
+    Example:
+        Keyed usage:
+        ```Python
+        @with_concurrency(5, key=lambda url: urlparse(url).netloc)
+        async def fetch(url: str) -> bytes:
+            ...
+
+        # Runs 5 fetches in parallel against each host
+        await asyncio.gather(*map(fetch, urls))
+        ```
+
     Args:
         parallel: The number of concurrent tasks being executed (must be positive).
+        key: Optional function called with the arguments of each call, returning
+            the hashable key to limit concurrency by. Calls with different keys
+            are limited independently.
+        metrics: Optional Prometheus metrics to record waiting and running calls in.
 
     Raises:
         TypeError: if parallel has the wrong type.
-        ValueError: if parallel is negative.
+        ValueError: if parallel is not positive.
 
     Returns:
         Decorator function to limit concurrency.
     """
-    semaphore = Semaphore(parallel)
+    _validate_parallel(parallel)
+    # Semaphores by loop and key, along with the number of calls using each.
+    # Entries are dropped once unused, as semaphores hold a strong reference to
+    # their loop, which would otherwise keep the loop alive.
+    semaphores: "WeakKeyDictionary[AbstractEventLoop, LoopSemaphores]" = (
+        WeakKeyDictionary()
+    )
 
-    #     # TODO: In Python 3.10+ the below wrapper can be replaced with:
-    #     @asynccontextmanager
-    #     async def limited_concurrency() -> AsyncGenerator[None, None]:
-    #         async with semaphore:
-    #             yield
-    #
-    #     return limited_concurrency()
+    @asynccontextmanager
+    async def limited_concurrency(*args: Any, **kwargs: Any) -> AsyncIterator[None]:
+        loop_semaphores = semaphores.setdefault(get_running_loop(), {})
+        semaphore_key = key(*args, **kwargs) if key is not None else None
+        if semaphore_key in loop_semaphores:
+            semaphore, users = loop_semaphores[semaphore_key]
+        else:
+            semaphore, users = Semaphore(parallel), 0
+        loop_semaphores[semaphore_key] = (semaphore, users + 1)
+        try:
+            if metrics is None:
+                await semaphore.acquire()
+            else:
+                with metrics.track_waiting():
+                    await semaphore.acquire()
+            async with _holding_slot(semaphore.acquire, semaphore.release) as slot:
+                try:
+                    yield
+                finally:
+                    if slot.held:
+                        semaphore.release()
+        finally:
+            semaphore, users = loop_semaphores[semaphore_key]
+            if users == 1:
+                del loop_semaphores[semaphore_key]
+            else:
+                loop_semaphores[semaphore_key] = (semaphore, users - 1)
 
     def wrapper(func: WithConcurrencyFunction) -> WithConcurrencyFunction:
         @wraps(func)
         async def wrapped(*args: Any, **kwargs: Any) -> ReturnType:
-            async with semaphore:
+            async with limited_concurrency(*args, **kwargs):
+                if metrics is None:
+                    return cast(ReturnType, await func(*args, **kwargs))
+                with metrics.track_running():
+                    return cast(ReturnType, await func(*args, **kwargs))
+
+        return wrapped
+
+    return wrapper
+
+
+class RateLimiter:
+    """Token-bucket rate limiter for async code.
+
+    Tokens are added at `rate` per second, up to `burst` tokens. Each acquisition
+    takes one token, waiting for it to be added if the bucket is empty. Waiters
+    reserve tokens in the order they arrive, without waiting on each other, so
+    the limiter can be shared freely between coroutines and event-loops, even
+    when running on different threads.
+
+    Can be used as an async context manager, or as a decorator. It composes with
+    `with_concurrency`, in which case the rate limiter should be applied innermost,
+    so that tokens are only taken by calls holding a concurrency slot.
+
+    Example:
+        ```Python
+        limiter = RateLimiter(rate=10, burst=5)
+
+        @with_concurrency(5)
+        @limiter
+        async def intensive_task(i: int) -> None:
+            ...
+            return i
+
+        # Runs at most 5 intensive_tasks in parallel, starting 10 per second
+        await asyncio.gather(*map(intensive_task, range(1000)))
+
+        async with limiter:
+            ...
+        ```
+
+    Args:
+        rate: Number of tokens added per second (must be positive).
+        burst: Maximum number of tokens in the bucket (must be positive).
+        clock: Monotonic clock returning the current time in seconds.
+        sleep: Coroutine function sleeping for the given number of seconds.
+
+    Raises:
+        ValueError: if rate or burst is not positive.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: int = 1,
+        clock: Callable[[], float] = monotonic,
+        sleep: Callable[[float], Awaitable[Any]] = asyncio_sleep,
+    ) -> None:
+        if rate <= 0:
+            raise ValueError(f"rate must be positive, got {rate}")
+        if burst < 1:
+            raise ValueError(f"burst must be positive, got {burst}")
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = float(burst)
+        self._updated = clock()
+        # Guards the bucket, as event-loops may run on different threads
+        self._lock = Lock()
+
+    def _refill(self) -> None:
+        """Add the tokens accrued since the last refill, holding the lock."""
+        now = self._clock()
+        self._tokens = min(
+            float(self.burst), self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    @property
+    def tokens(self) -> float:
+        """Number of tokens currently available, negative if calls are waiting."""
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+    async def acquire(self) -> None:
+        """Take a token, waiting for it to be added if none are available."""
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            tokens = self._tokens
+        if tokens >= 0:
+            return
+        try:
+            await self._sleep(-tokens / self.rate)
+        except BaseException:
+            # Give back our reservation, so we do not hold up later callers
+            with self._lock:
+                self._tokens += 1
+            raise
+
+    async def __aenter__(self) -> None:
+        await self.acquire()
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        pass
+
+    def __call__(self, func: WithConcurrencyFunction) -> WithConcurrencyFunction:
+        """Decorate a coroutine function, taking a token before each call.
+
+        Args:
+            func: The coroutine function to rate limit.
+
+        Returns:
+            The rate limited coroutine function.
+        """
+
+        @wraps(func)
+        async def wrapped(*args: Any, **kwargs: Any) -> ReturnType:
+            await self.acquire()
+            return cast(ReturnType, await func(*args, **kwargs))
+
+        return wrapped
+
+
+def with_rate_limit(
+    rate: float,
+    burst: int = 1,
+    clock: Callable[[], float] = monotonic,
+    sleep: Callable[[float], Awaitable[Any]] = asyncio_sleep,
+) -> Callable[[WithConcurrencyFunction], WithConcurrencyFunction]:
+    """Decorator which limits the rate of calls using a token bucket.
+
+    Example:
+        ```Python
+        @with_concurrency(5)
+        @with_rate_limit(10, burst=5)
+        async def intensive_task(i: int) -> None:
+            ...
+            return i
+
+        tasks = list(map(intensive_task, range(1000)))
+
+        # Runs at most 5 intensive_tasks in parallel, starting 10 per second
+        await gather_with_concurrency(5, *tasks)
+        ```
+
+    Args:
+        rate: Number of calls allowed per second (must be positive).
+        burst: Number of calls allowed in a burst (must be positive).
+        clock: Monotonic clock returning the current time in seconds.
+        sleep: Coroutine function sleeping for the given number of seconds.
+
+    Raises:
+        ValueError: if rate or burst is not positive.
+
+    Returns:
+        Decorator function to limit the call rate.
+    """
+    return RateLimiter(rate, burst, clock, sleep)
+
+
+class AdaptiveConcurrency:
+    """Adaptive concurrency limiter using additive-increase/multiplicative-decrease.
+
+    The limit grows by `increase` for every `limit` successful calls, that is
+    roughly `increase` per round-trip, as long as calls finish within
+    `latency_threshold`. Whenever a call fails with one of `errors`, or exceeds the
+    latency threshold, the limit is multiplied by `decrease`. Only calls started
+    after the latest decrease can decrease the limit again, so a single burst of
+    failures only decreases the limit once.
+
+    Can be used as a decorator, through the `slot` async context manager, or in
+    place of the fixed concurrency limit in `gather_with_concurrency`.
+
+    Example:
+        ```Python
+        limiter = AdaptiveConcurrency(initial=5, maximum=50, latency_threshold=2.0)
+
+        @limiter
+        async def intensive_task(i: int) -> None:
+            ...
+            return i
+
+        tasks = list(map(intensive_task, range(1000)))
+
+        # Runs between 1 and 50 intensive_tasks in parallel, depending on health
+        await asyncio.gather(*tasks)
+        # Graph the current limit
+        print(limiter.limit)
+        ```
+
+    Args:
+        initial: The initial concurrency limit.
+        minimum: The lowest the limit can be decreased to (must be positive).
+        maximum: The highest the limit can be increased to.
+        increase: How much to increase the limit per round-trip of successful calls.
+        decrease: Factor to multiply the limit by on failure (between 0 and 1).
+        latency_threshold: Call duration in seconds above which the call is
+            considered unhealthy, or `None` to only consider errors.
+        errors: Exception types which are considered unhealthy.
+        clock: Monotonic clock returning the current time in seconds.
+
+    Raises:
+        ValueError: if the limits, the increase or the decrease are out of range.
+    """
+
+    def __init__(
+        self,
+        initial: int = 1,
+        minimum: int = 1,
+        maximum: int = 100,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+        latency_threshold: Optional[float] = None,
+        errors: Tuple[Type[BaseException], ...] = (Exception,),
+        clock: Callable[[], float] = monotonic,
+    ) -> None:
+        if not 1 <= minimum <= initial <= maximum:
+            raise ValueError("limits must satisfy 1 <= minimum <= initial <= maximum")
+        if increase <= 0:
+            raise ValueError(f"increase must be positive, got {increase}")
+        if not 0 < decrease < 1:
+            raise ValueError(f"decrease must be between 0 and 1, got {decrease}")
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_threshold = latency_threshold
+        self.errors = errors
+        self.in_flight = 0
+        self._limit = float(initial)
+        self._clock = clock
+        self._decreased_at = -inf
+        self._waiters: Deque["Future[None]"] = deque()
+
+    @property
+    def limit(self) -> int:
+        """The current concurrency limit."""
+        return int(self._limit)
+
+    def _wake_waiters(self) -> None:
+        """Hand out free slots to waiters, in the order they arrived."""
+        while self._waiters and self.in_flight < self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def _release(self) -> None:
+        """Give back a slot, handing it to the next waiter if any."""
+        self.in_flight -= 1
+        self._wake_waiters()
+
+    async def _acquire(self) -> None:
+        """Take a slot, waiting for one to free up if none are available."""
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            return
+        waiter: "Future[None]" = get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # We were handed a slot, but cancelled before we could use it
+                self._release()
+            raise
+
+    def _on_success(self, started: float) -> None:
+        if (
+            self.latency_threshold is not None
+            and self._clock() - started > self.latency_threshold
+        ):
+            self._on_failure(started)
+            return
+        self._limit = min(
+            float(self.maximum), self._limit + self.increase / self._limit
+        )
+
+    def _on_failure(self, started: float) -> None:
+        if started < self._decreased_at:
+            return
+        self._limit = max(float(self.minimum), self._limit * self.decrease)
+        self._decreased_at = self._clock()
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Hold a concurrency slot, adjusting the limit based on the outcome."""
+        await self._acquire()
+        started = self._clock()
+        async with _holding_slot(self._acquire, self._release) as slot:
+            try:
+                yield
+            except self.errors:
+                self._on_failure(started)
+                raise
+            else:
+                self._on_success(started)
+            finally:
+                if slot.held:
+                    self._release()
+
+    def __call__(self, func: WithConcurrencyFunction) -> WithConcurrencyFunction:
+        """Decorate a coroutine function, holding a slot during each call.
+
+        Args:
+            func: The coroutine function to limit.
+
+        Returns:
+            The limited coroutine function.
+        """
+
+        @wraps(func)
+        async def wrapped(*args: Any, **kwargs: Any) -> ReturnType:
+            async with self.slot():
                 return cast(ReturnType, await func(*args, **kwargs))
 
         return wrapped
 
+
+@dataclass
+class _BatchState(Generic[KeyType, ValueType]):
+    """State of a `BatchLoader` within a single event-loop.
+
+    Attributes:
+        cache: Futures of cached results, by key.
+        pending: Futures of keys waiting for the next batch, by key.
+        handle: Handle of the scheduled dispatch of the next batch, if any.
+    """
+
+    cache: Dict[KeyType, "Future[ValueType]"] = field(default_factory=dict)
+    pending: Dict[KeyType, "Future[ValueType]"] = field(default_factory=dict)
+    handle: Optional[Union[Handle, TimerHandle]] = None
+
+
+class BatchLoader(Generic[KeyType, ValueType]):
+    """DataLoader-style micro-batching of async lookups.
+
+    Individual `load` calls made within the same event-loop iteration, or within
+    `delay` seconds of the first, are collected into a single call to
+    `batch_function`, with at most `max_batch_size` keys per call. Identical keys
+    are only looked up once, and if `cache` is set, results are remembered for the
+    lifetime of the loader. The cache is never evicted, so a long-lived loader,
+    such as one created at module level by `with_batching`, caches every result
+    for the lifetime of the process. Loaders should therefore be scoped to a
+    single request or job, using `scoped` to create a fresh loader with an empty
+    cache, or have `cache` unset.
+
+    Batches and caches are kept per running event-loop, so a loader can be used
+    from several event-loops at once, such as one per thread. The state of an
+    event-loop is dropped along with it, or once it is closed.
+
+    The batch function is called with a list of distinct keys, and must return
+    either a sequence of values in the same order, or a mapping from keys to
+    values. Keys missing from a returned mapping raise `KeyError` for the callers
+    waiting on them.
+
+    Example:
+        ```Python
+        @with_batching(max_batch_size=100)
+        async def load_employees(uuids: List[UUID]) -> Dict[UUID, Employee]:
+            ...  # Single GraphQL query for all uuids
+
+        async def handle_request(uuids: List[UUID]) -> None:
+            loader = load_employees.scoped()
+            # One call to load_employees with up to 100 uuids
+            employees = await asyncio.gather(*map(loader, uuids))
+        ```
+
+    Args:
+        batch_function: Coroutine function looking up a list of keys at once.
+        max_batch_size: The maximum number of keys per batch (must be positive).
+        delay: Seconds to wait for more keys before dispatching a batch, or zero
+            to dispatch at the end of the current event-loop iteration.
+        cache: Whether to remember results between batches.
+
+    Raises:
+        ValueError: if max_batch_size is not positive or delay is negative.
+    """
+
+    def __init__(
+        self,
+        batch_function: BatchFunction,
+        max_batch_size: int = 100,
+        delay: float = 0.0,
+        cache: bool = True,
+    ) -> None:
+        if max_batch_size < 1:
+            raise ValueError(f"max_batch_size must be positive, got {max_batch_size}")
+        if delay < 0:
+            raise ValueError(f"delay must not be negative, got {delay}")
+        self.batch_function = batch_function
+        self.max_batch_size = max_batch_size
+        self.delay = delay
+        self.cache = cache
+        # State by event-loop, as futures and handles are bound to their loop
+        self._states: "WeakKeyDictionary[AbstractEventLoop, _BatchState]" = (
+            WeakKeyDictionary()
+        )
+        self._states_lock = Lock()
+        # Strong references to running batches, so they are not garbage collected
+        self._batches: Set["Task[None]"] = set()
+        update_wrapper(self, batch_function)
+
+    def scoped(self) -> "BatchLoader[KeyType, ValueType]":
+        """Create a loader with the same settings, but an empty cache.
+
+        Returns:
+            The new loader.
+        """
+        return BatchLoader(
+            self.batch_function, self.max_batch_size, self.delay, self.cache
+        )
+
+    def clear(self) -> None:
+        """Forget all cached results."""
+        with self._states_lock:
+            for state in self._states.values():
+                state.cache.clear()
+
+    def _state(self, loop: AbstractEventLoop) -> _BatchState:
+        """Get the state of an event-loop, creating it on first use.
+
+        Cached futures keep their event-loop alive, so the states of closed
+        event-loops are dropped whenever a new event-loop is seen.
+
+        Args:
+            loop: The running event-loop.
+
+        Returns:
+            The state of the event-loop.
+        """
+        state = self._states.get(loop)
+        if state is not None:
+            return state
+        with self._states_lock:
+            for other in [other for other in self._states if other.is_closed()]:
+                del self._states[other]
+            return self._states.setdefault(loop, _BatchState())
+
+    async def load(self, key: KeyType) -> ValueType:
+        """Look up a single key, as part of a batch.
+
+        Args:
+            key: The key to look up.
+
+        Returns:
+            The value for the key, as returned by the batch function.
+        """
+        loop = get_running_loop()
+        state = self._state(loop)
+        future = state.cache.get(key)
+        if future is None:
+            future = state.pending.get(key)
+        if future is None:
+            future = loop.create_future()
+            state.pending[key] = future
+            if self.cache:
+                state.cache[key] = future
+            if len(state.pending) >= self.max_batch_size:
+                self._dispatch(state)
+            elif state.handle is None:
+                if self.delay:
+                    state.handle = loop.call_later(self.delay, self._dispatch, state)
+                else:
+                    state.handle = loop.call_soon(self._dispatch, state)
+        # Shielded, as the future is shared with other callers
+        return await shield(future)
+
+    async def load_many(self, keys: Iterable[KeyType]) -> List[ValueType]:
+        """Look up several keys, as part of one or more batches.
+
+        Args:
+            keys: The keys to look up.
+
+        Returns:
+            The values for the keys, in the same order.
+        """
+        return list(await gather(*map(self.load, keys)))
+
+    __call__ = load
+
+    def _dispatch(self, state: _BatchState) -> None:
+        """Start a batch call for all pending keys.
+
+        Args:
+            state: The state of the running event-loop.
+        """
+        if state.handle is not None:
+            state.handle.cancel()
+            state.handle = None
+        batch, state.pending = state.pending, {}
+        task = ensure_future(self._run_batch(state, batch))
+        self._batches.add(task)
+        task.add_done_callback(self._batches.discard)
+
+    async def _run_batch(
+        self, state: _BatchState, batch: Dict[KeyType, "Future[ValueType]"]
+    ) -> None:
+        """Call the batch function, and fan the results out to the waiting futures.
+
+        Args:
+            state: The state of the running event-loop.
+            batch: Futures to resolve, by key.
+        """
+        keys = list(batch)
+        try:
+            values = await self.batch_function(keys)
+            if not isinstance(values, Mapping) and len(values) != len(keys):
+                raise ValueError(
+                    f"batch function returned {len(values)} values "
+                    f"for {len(keys)} keys"
+                )
+        except Exception as err:
+            for key, future in batch.items():
+                self._fail(state, key, future, err)
+            return
+
+        if not isinstance(values, Mapping):
+            values = dict(zip(keys, values))
+        for key, future in batch.items():
+            if key not in values:
+                self._fail(state, key, future, KeyError(key))
+            elif not future.done():
+                future.set_result(values[key])
+
+    def _fail(
+        self,
+        state: _BatchState,
+        key: KeyType,
+        future: "Future[ValueType]",
+        err: BaseException,
+    ) -> None:
+        """Fail a future, without caching the failure.
+
+        Args:
+            state: The state of the running event-loop.
+            key: The key which failed.
+            future: The future to fail.
+            err: The exception to fail with.
+        """
+        if state.cache.get(key) is future:
+            del state.cache[key]
+        if not future.done():
+            future.set_exception(err)
+
+
+def with_batching(
+    max_batch_size: int = 100,
+    delay: float = 0.0,
+    cache: bool = True,
+) -> Callable[[BatchFunction], BatchLoader]:
+    """Decorator which turns a batch lookup function into a `BatchLoader`.
+
+    *Note: With `cache` set, the decorated loader caches every result for the
+           lifetime of the process, as it is never evicted. Use `scoped` to get
+           a loader caching per request or job, or unset `cache`.*
+
+    Example:
+        ```Python
+        @with_batching(max_batch_size=50)
+        async def load_classes(uuids: List[UUID]) -> List[Class]:
+            ...  # Single request for all uuids
+
+        # One call to load_classes, with 3 uuids
+        await asyncio.gather(load_classes(a), load_classes(b), load_classes(a), ...)
+        ```
+
+    Args:
+        max_batch_size: The maximum number of keys per batch (must be positive).
+        delay: Seconds to wait for more keys before dispatching a batch, or zero
+            to dispatch at the end of the current event-loop iteration.
+        cache: Whether to remember results between batches.
+
+    Raises:
+        ValueError: if max_batch_size is not positive or delay is negative.
+
+    Returns:
+        Decorator function creating a batch loader.
+    """
+
+    def wrapper(func: BatchFunction) -> BatchLoader:
+        return BatchLoader(func, max_batch_size, delay, cache)
+
+    return wrapper
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """Exponential backoff policy for `with_retry`.
+
+    The delay before retry number `n` (counting from zero) is
+    `min(max_delay, base_delay * multiplier ** n)`, of which a random fraction of
+    up to `jitter` is subtracted, to avoid retrying in lock-step.
+
+    Args:
+        attempts: The maximum number of attempts, including the first one.
+        base_delay: The delay in seconds before the first retry.
+        max_delay: The maximum delay in seconds between attempts.
+        multiplier: Factor to multiply the delay by after each retry.
+        jitter: Fraction of the delay to randomize, from 0 (none) to 1 (full).
+    """
+
+    attempts: int = 3
+    base_delay: float = 0.1
+    max_delay: float = 10.0
+    multiplier: float = 2.0
+    jitter: float = 1.0
+
+    def __post_init__(self) -> None:
+        if self.attempts < 1:
+            raise ValueError(f"attempts must be positive, got {self.attempts}")
+        if not 0 <= self.jitter <= 1:
+            raise ValueError(f"jitter must be between 0 and 1, got {self.jitter}")
+
+    def delay(self, retry: int, random: Callable[[], float] = random) -> float:
+        """Calculate the delay before a retry.
+
+        Args:
+            retry: Number of retries before this one.
+            random: Function returning a random float in the interval [0, 1).
+
+        Returns:
+            The delay in seconds.
+        """
+        delay = min(self.max_delay, self.base_delay * self.multiplier**retry)
+        return delay * (1 - self.jitter * random())
+
+
+def with_retry(
+    policy: Union[RetryPolicy, Mapping[Type[BaseException], RetryPolicy]] = (
+        RetryPolicy()
+    ),
+    budget: Optional[float] = None,
+    clock: Callable[[], float] = monotonic,
+    sleep: Callable[[float], Awaitable[Any]] = asyncio_sleep,
+    random: Callable[[], float] = random,
+) -> Callable[[WithConcurrencyFunction], WithConcurrencyFunction]:
+    """Decorator which retries failing calls with exponential backoff and jitter.
+
+    While backing off, the concurrency slot held from `with_concurrency`,
+    `gather_with_concurrency` or `AdaptiveConcurrency` is released, so other
+    tasks can make progress in the meantime.
+
+    Example:
+        ```Python
+        @with_concurrency(5)
+        @with_retry(
+            {
+                asyncio.TimeoutError: RetryPolicy(attempts=5),
+                ConnectionError: RetryPolicy(attempts=3, base_delay=1.0),
+            },
+            budget=60,
+        )
+        async def intensive_task(i: int) -> None:
+            ...
+            return i
+
+        tasks = list(map(intensive_task, range(1000)))
+        await asyncio.gather(*tasks)
+        ```
+
+    Args:
+        policy: Retry policy for all exceptions, or mapping from exception types
+            to retry policies. Exceptions are matched against the mapping in
+            order, and exceptions not matched are raised immediately. Attempts
+            are counted separately for each exception type in the mapping.
+        budget: Maximum time in seconds from the first attempt, after which no
+            further retries are started, or `None` for no limit.
+        clock: Monotonic clock returning the current time in seconds.
+        sleep: Coroutine function sleeping for the given number of seconds.
+        random: Function returning a random float in the interval [0, 1).
+
+    Returns:
+        Decorator function to retry calls.
+    """
+    policies = policy if isinstance(policy, Mapping) else {Exception: policy}
+
+    def find_policy(
+        err: BaseException,
+    ) -> Optional[Tuple[Type[BaseException], RetryPolicy]]:
+        for exception_type, exception_policy in policies.items():
+            if isinstance(err, exception_type):
+                return exception_type, exception_policy
+        return None
+
+    def wrapper(func: WithConcurrencyFunction) -> WithConcurrencyFunction:
+        @wraps(func)
+        async def wrapped(*args: Any, **kwargs: Any) -> ReturnType:
+            deadline = clock() + budget if budget is not None else inf
+            # Retries by matched exception type, as equal policies compare equal
+            retries: Dict[Type[BaseException], int] = defaultdict(int)
+            while True:
+                try:
+                    return cast(ReturnType, await func(*args, **kwargs))
+                except Exception as err:
+                    matched = find_policy(err)
+                    if matched is None:
+                        raise
+                    err_type, err_policy = matched
+                    retry = retries[err_type]
+                    if retry + 1 >= err_policy.attempts:
+                        raise
+                    delay = err_policy.delay(retry, random)
+                    if clock() + delay > deadline:
+                        raise
+                    retries[err_type] += 1
+                async with released_slot():
+                    await sleep(delay)
+
+        return wrapped
+
     return wrapper
 
 
 async def gather_with_concurrency(
-    parallel: int, *tasks: Awaitable[ReturnType]
+    parallel: Union[int, AdaptiveConcurrency],
+    *tasks: Awaitable[ReturnType],
+    return_exceptions: bool = False,
+    fail_fast: bool = False,
+    task_timeout: Optional[float] = None,
+    timeout: Optional[float] = None,
 ) -> List[ReturnType]:
     """Asyncio gather, but with limited concurrency.
 
@@ -81,22 +1089,483 @@ async def gather_with_concurrency(
         await asyncio.gather(*tasks)
         # Runs at most 5 intensive_tasks in parallel, through all 1000
         await gather_with_concurrency(5, *tasks)
+        # Same, but cancels the remaining tasks as soon as one fails, or times out
+        await gather_with_concurrency(5, *tasks, fail_fast=True, task_timeout=10)
         ```
 
     Args:
-        parallel: The number of concurrent tasks being executed (must be positive).
+        parallel: The number of concurrent tasks being executed (must be positive),
+            or an `AdaptiveConcurrency` limiter to adjust it dynamically.
         tasks: List of tasks to execute.
+        return_exceptions: Whether to return exceptions raised by the tasks in the
+            result list, like `asyncio.gather`, rather than raising the first one.
+        fail_fast: Whether to cancel all outstanding tasks when the first one
+            raises, rather than leaving them running.
+        task_timeout: Maximum time in seconds each task may run for, once started,
+            after which it is cancelled and `asyncio.TimeoutError` is raised.
+        timeout: Maximum time in seconds for all tasks to finish, after which all
+            outstanding tasks are cancelled and `asyncio.TimeoutError` is raised.
 
     Raises:
         TypeError: if parallel has the wrong type.
-        ValueError: if parallel is negative.
+        ValueError: if parallel is not positive.
+        asyncio.TimeoutError: if timeout expires, or task_timeout expires and
+            return_exceptions is not set.
 
     Returns:
-        List of return values from awaiting the tasks.
+        List of return values from awaiting the tasks, including exceptions if
+        return_exceptions is set.
     """
 
-    @with_concurrency(parallel)
+    limiter = (
+        parallel
+        if isinstance(parallel, AdaptiveConcurrency)
+        else with_concurrency(parallel)
+    )
+
+    @limiter
+    async def limited_task(task: Awaitable[ReturnType]) -> ReturnType:
+        if task_timeout is None:
+            return await task
+        return await wait_for(task, task_timeout)
+
     async def resolver_task(task: Awaitable[ReturnType]) -> ReturnType:
-        return await task
+        try:
+            return cast(ReturnType, await limited_task(task))
+        finally:
+            # Avoid never awaited warnings, if cancelled before being started
+            if iscoroutine(task):
+                task.close()
+
+    futures = list(map(ensure_future, map(resolver_task, tasks)))
+    try:
+        return cast(
+            List[ReturnType],
+            await wait_for(
+                gather(*futures, return_exceptions=return_exceptions), timeout
+            ),
+        )
+    except BaseException:
+        if fail_fast:
+            for future in futures:
+                future.cancel()
+        raise
+
+
+async def as_completed_with_concurrency(
+    parallel: int,
+    factories: Union[
+        Iterable[TaskFactory[ReturnType]], AsyncIterable[TaskFactory[ReturnType]]
+    ],
+    ordered: bool = False,
+    window: Optional[int] = None,
+) -> AsyncIterator[ReturnType]:
+    """Streaming gather with limited concurrency and bounded memory.
+
+    Unlike `gather_with_concurrency`, tasks are created lazily from `factories`
+    as concurrency slots free up, and results are yielded as soon as they are
+    available. At most `parallel` tasks are running, and at most `window` results
+    are held back waiting for earlier ones, so memory usage is `O(window)`
+    regardless of the number of factories.
+
+    If a task raises, the exception is propagated to the consumer and all
+    outstanding tasks are cancelled. The same happens if the consumer stops
+    iterating early.
+
+    Example:
+        ```Python
+        async def intensive_task(i: int) -> int:
+            ...
+            return i
+
+        factories = (partial(intensive_task, i) for i in range(1_000_000))
+
+        # Runs at most 5 intensive_tasks in parallel, yielding in completion order
+        async for result in as_completed_with_concurrency(5, factories):
+            print(result)
+
+        # Same, but yielding in input order
+        async for result in as_completed_with_concurrency(
+            5, factories, ordered=True, window=20
+        ):
+            print(result)
+        ```
+
+    Args:
+        parallel: The number of concurrent tasks being executed (must be positive).
+        factories: Iterable or async iterable of zero-argument callables, each
+            returning an awaitable when called.
+        ordered: Whether to yield results in input order rather than completion order.
+        window: Maximum number of started tasks whose results have not yet been
+            yielded, when `ordered` is set. Defaults to `parallel`, and must be at
+            least `parallel`.
+
+    Raises:
+        TypeError: if parallel has the wrong type.
+        ValueError: if parallel is not positive, or window is smaller than parallel.
+
+    Yields:
+        Return values from awaiting the tasks.
+    """
+    _validate_parallel(parallel)
+    if window is None:
+        window = parallel
+    if window < parallel:
+        raise ValueError(f"window must be at least parallel, got {window}")
+
+    source = _aiter(factories)
+    exhausted = False
+    running: Set["Task[ReturnType]"] = set()
+    # Started tasks, in input order, whose results have not been yielded yet
+    buffer: Deque["Task[ReturnType]"] = deque()
+
+    try:
+        while True:
+            while not exhausted and len(running) < parallel and len(buffer) < window:
+                try:
+                    factory = await source.__anext__()
+                except StopAsyncIteration:
+                    exhausted = True
+                    break
+                task = ensure_future(factory())
+                running.add(task)
+                if ordered:
+                    buffer.append(task)
+
+            if not running and not buffer:
+                return
+
+            if ordered and buffer[0].done():
+                yield buffer.popleft().result()
+                continue
+
+            done, _ = await wait(running, return_when=FIRST_COMPLETED)
+            for task in done:
+                running.remove(task)
+                if not ordered:
+                    yield task.result()
+    finally:
+        for task in running:
+            task.cancel()
+        # Retrieve the outcome of every task, so failures are not logged as unseen
+        await gather(*running, *buffer, return_exceptions=True)
+
+
+# Marks the end of the input to a pipeline stage
+_END_OF_STAGE = object()
+
+
+@dataclass
+class PipelineStage:
+    """A stage of a `Pipeline`.
+
+    Args:
+        func: Coroutine function processing a single item, returning the item to
+            pass on to the next stage.
+        parallel: The number of items processed concurrently (must be positive).
+        queue_size: The number of items which can be queued up for the stage,
+            defaults to `parallel`.
+        name: Name of the stage in the statistics, defaults to the function name.
+    """
+
+    func: Callable[[Any], Awaitable[Any]]
+    parallel: int = 1
+    queue_size: Optional[int] = None
+    name: Optional[str] = None
+
+    def __post_init__(self) -> None:
+        _validate_parallel(self.parallel)
+        if self.queue_size is None:
+            self.queue_size = self.parallel
+        if self.queue_size < 1:
+            raise ValueError(f"queue_size must be positive, got {self.queue_size}")
+        if self.name is None:
+            self.name = getattr(self.func, "__name__", repr(self.func))
+
+
+@dataclass
+class StageStatistics:
+    """Throughput statistics for a stage of a running or finished `Pipeline`.
+
+    Args:
+        name: Name of the stage.
+        started: Time the pipeline was started.
+        finished: Time the stage finished processing its last item.
+        processed: Number of items processed.
+        busy_seconds: Total time spent processing items, summed over all workers.
+        clock: Monotonic clock returning the current time in seconds.
+    """
+
+    name: str
+    started: float
+    finished: Optional[float] = None
+    processed: int = 0
+    busy_seconds: float = 0.0
+    clock: Callable[[], float] = field(default=monotonic, repr=False)
+
+    @property
+    def elapsed(self) -> float:
+        """Seconds from the pipeline started, until the stage finished or now."""
+        finished = self.finished if self.finished is not None else self.clock()
+        return finished - self.started
+
+    @property
+    def throughput(self) -> float:
+        """Items processed per second."""
+        elapsed = self.elapsed
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+
+class Pipeline:
+    """Bounded multi-stage async pipeline.
+
+    Each stage runs `parallel` workers, taking items from a bounded queue filled
+    by the previous stage, and putting their results on the queue of the next
+    stage. When a stage falls behind, its queue fills up and the previous stages
+    wait, so backpressure flows upstream, and at most a bounded number of items
+    are in memory at a time. The results of the last stage are discarded, so it
+    should write the items to their destination.
+
+    If any stage raises, all stages are cancelled and the exception is raised.
+
+    Example:
+        ```Python
+        pipeline = Pipeline(
+            PipelineStage(read_employee, parallel=10),
+            PipelineStage(transform_employee, parallel=2),
+            PipelineStage(write_employee, parallel=5, queue_size=100),
+        )
+        for stage in await pipeline.run(employee_uuids):
+            print(stage.name, stage.throughput)
+        ```
+
+    Args:
+        stages: The stages of the pipeline, in order.
+        clock: Monotonic clock returning the current time in seconds.
+
+    Raises:
+        ValueError: if no stages are given.
+    """
+
+    def __init__(
+        self, *stages: PipelineStage, clock: Callable[[], float] = monotonic
+    ) -> None:
+        if not stages:
+            raise ValueError("at least one stage must be given")
+        self.stages = stages
+        self.statistics: List[StageStatistics] = []
+        self._clock = clock
+
+    async def _feed(
+        self, source: Union[Iterable[Any], AsyncIterable[Any]], queue: "Queue[Any]"
+    ) -> None:
+        """Put the items from the source on the queue of the first stage.
+
+        Args:
+            source: Items to feed to the pipeline.
+            queue: The queue of the first stage.
+        """
+        async for item in _aiter(source):
+            await queue.put(item)
+        for _ in range(self.stages[0].parallel):
+            await queue.put(_END_OF_STAGE)
+
+    async def _work(
+        self, index: int, queues: List["Queue[Any]"], remaining: List[int]
+    ) -> None:
+        """Process items for a stage, until the end of its input.
+
+        Args:
+            index: Index of the stage.
+            queues: The queues of all stages.
+            remaining: Number of workers still running, for each stage.
+        """
+        stage = self.stages[index]
+        statistics = self.statistics[index]
+        queue = queues[index]
+        next_queue = queues[index + 1] if index + 1 < len(queues) else None
+        while True:
+            item = await queue.get()
+            if item is _END_OF_STAGE:
+                break
+            started = self._clock()
+            result = await stage.func(item)
+            statistics.busy_seconds += self._clock() - started
+            statistics.processed += 1
+            if next_queue is not None:
+                await next_queue.put(result)
+
+        remaining[index] -= 1
+        if remaining[index] == 0:
+            statistics.finished = self._clock()
+            if next_queue is not None:
+                for _ in range(self.stages[index + 1].parallel):
+                    await next_queue.put(_END_OF_STAGE)
+
+    async def run(
+        self, source: Union[Iterable[Any], AsyncIterable[Any]]
+    ) -> List[StageStatistics]:
+        """Run all items from the source through the pipeline.
+
+        The statistics are also available from `statistics` while running.
+
+        Args:
+            source: Iterable or async iterable of items to feed to the pipeline.
+
+        Returns:
+            Throughput statistics for each stage.
+        """
+        started = self._clock()
+        self.statistics = [
+            StageStatistics(cast(str, stage.name), started, clock=self._clock)
+            for stage in self.stages
+        ]
+        queues: List["Queue[Any]"] = [
+            Queue(maxsize=cast(int, stage.queue_size)) for stage in self.stages
+        ]
+        remaining = [stage.parallel for stage in self.stages]
+        tasks = [ensure_future(self._feed(source, queues[0]))]
+        for index, stage in enumerate(self.stages):
+            tasks.extend(
+                ensure_future(self._work(index, queues, remaining))
+                for _ in range(stage.parallel)
+            )
+        try:
+            await gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            # Let the stages clean up before returning, or raising to the caller
+            await gather(*tasks, return_exceptions=True)
+        return self.statistics
+
+
+# Process-wide executors shared by `gather_in_executor`, by whether they use processes
+_shared_executors: Dict[bool, Executor] = {}
+_shared_executor_sizes: Dict[bool, Optional[int]] = {}
+_shared_executors_lock = Lock()
+
+
+def shared_executor(processes: bool = False) -> Executor:
+    """Get the process-wide shared executor, creating it on first use.
+
+    The thread pool is sized like `ThreadPoolExecutor` by default, and the
+    process pool has one worker per CPU, unless configured otherwise using
+    `configure_shared_executor`.
+
+    Args:
+        processes: Whether to get the process pool rather than the thread pool.
+
+    Returns:
+        The shared executor.
+    """
+    with _shared_executors_lock:
+        if processes not in _shared_executors:
+            max_workers = _shared_executor_sizes.get(processes)
+            _shared_executors[processes] = (
+                ProcessPoolExecutor(max_workers)
+                if processes
+                else ThreadPoolExecutor(max_workers, thread_name_prefix="ra_utils")
+            )
+        return _shared_executors[processes]
+
+
+def configure_shared_executor(
+    max_workers: Optional[int], processes: bool = False
+) -> None:
+    """Set the number of workers of the process-wide shared executor.
+
+    If the executor was already created, a new one is created on next use. The
+    replaced executor is not shut down, as callers may still be submitting work
+    to it, but its workers exit once it is no longer referenced.
+
+    Example:
+        ```Python
+        configure_shared_executor(8)
+        assert shared_executor()._max_workers == 8
+        ```
+
+    Args:
+        max_workers: The maximum number of workers (must be positive), or `None`
+            for the default.
+        processes: Whether to configure the process pool rather than the thread
+            pool.
+
+    Raises:
+        ValueError: if max_workers is not positive.
+    """
+    if max_workers is not None and max_workers < 1:
+        raise ValueError(f"max_workers must be positive, got {max_workers}")
+    with _shared_executors_lock:
+        _shared_executor_sizes[processes] = max_workers
+        _shared_executors.pop(processes, None)
+
+
+def _call_all(funcs: List[Callable[[], ReturnType]]) -> List[ReturnType]:
+    """Call each function in turn, in the executor.
+
+    Args:
+        funcs: The functions to call.
+
+    Returns:
+        List of return values from calling the functions.
+    """
+    return [func() for func in funcs]
+
+
+async def gather_in_executor(
+    parallel: int,
+    *funcs: Callable[[], ReturnType],
+    executor: Optional[Executor] = None,
+    processes: bool = False,
+    chunksize: int = 1,
+) -> List[ReturnType]:
+    """Like `gather_with_concurrency`, but for blocking or CPU-bound callables.
+
+    The callables are run on an executor, with at most `parallel` chunks of
+    `chunksize` callables submitted at a time. Chunking amortizes the overhead of
+    submitting to the executor, which is significant for process pools, where
+    every submission is pickled and sent to a worker.
+
+    Example:
+        ```Python
+        def intensive_task(i: int) -> int:
+            ...
+            return i
+
+        funcs = [partial(intensive_task, i) for i in range(1000)]
+
+        # Runs at most 5 intensive_tasks in parallel, on the shared thread pool
+        await gather_in_executor(5, *funcs)
+        # Runs at most 4 chunks of 50 intensive_tasks in parallel, on processes
+        await gather_in_executor(4, *funcs, processes=True, chunksize=50)
+        ```
+
+    Args:
+        parallel: The number of concurrent chunks being executed (must be positive).
+        funcs: Zero-argument callables to run. Must be picklable for processes.
+        executor: The executor to run on, instead of the shared one.
+        processes: Whether to use the shared process pool, rather than the shared
+            thread pool, if no executor is given.
+        chunksize: The number of callables to submit to the executor at a time.
+
+    Raises:
+        TypeError: if parallel has the wrong type.
+        ValueError: if parallel or chunksize is not positive.
+
+    Returns:
+        List of return values from calling the callables.
+    """
+    _validate_parallel(parallel)
+    if chunksize < 1:
+        raise ValueError(f"chunksize must be positive, got {chunksize}")
+    if executor is None:
+        executor = shared_executor(processes)
+    loop = get_running_loop()
+
+    async def run_chunk(chunk: List[Callable[[], ReturnType]]) -> List[ReturnType]:
+        return await loop.run_in_executor(executor, _call_all, chunk)
 
-    return cast(List[ReturnType], await gather(*map(resolver_task, tasks)))
+    chunks = map(run_chunk, chunked(funcs, chunksize))
+    results = await gather_with_concurrency(parallel, *chunks)
+    return list(chain.from_iterable(results))
@@ -1,11 +1,35 @@
 # SPDX-FileCopyrightText: 2021 Magenta ApS <https://magenta.dk>
 # SPDX-License-Identifier: MPL-2.0
 import hashlib
+from concurrent.futures import Executor
 from functools import lru_cache
 from functools import partial
-from typing import Callable
+from itertools import repeat
+from typing import Any
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import MutableSequence
+from typing import Optional
+from typing import overload
+from typing import Tuple
+from typing import Type
+from typing import Union
 from uuid import UUID
 
+from more_itertools import chunked
+
+from .asyncio_utils import shared_executor
+
+_has_numpy = True
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    _has_numpy = False
+
+# Writable, contiguous buffer, such as a bytearray, memoryview or NumPy array
+Buffer = Any
+
 
 @lru_cache(maxsize=None)
 def _generate_uuid(value: str) -> UUID:
@@ -39,7 +63,329 @@ def generate_uuid(base: str, value: str) -> UUID:
     return _generate_uuid(str(base_uuid) + str(value))
 
 
-def uuid_generator(base: str) -> Callable[[str], UUID]:
+class UuidGenerator:
+    """Predictable UUID generator with a fixed base/seed.
+
+    Generates the same UUIDs as `generate_uuid`, but hashes the base only once,
+    reusing the hash state of the base for every value, and caches the UUIDs
+    in a bounded LRU cache.
+
+    Example:
+        ```Python
+        uuid_gen = UuidGenerator("secret_seed", maxsize=2)
+        assert uuid_gen("facetnavn1") == generate_uuid("secret_seed", "facetnavn1")
+        uuid_gen("facetnavn1")
+        print(uuid_gen.cache_info())  # --> CacheInfo(hits=1, misses=1, ...)
+        ```
+
+    Args:
+        base: Base or seed utilized to generate all UUIDs.
+        maxsize: Maximum number of UUIDs to cache, `None` for no limit.
+    """
+
+    def __init__(self, base: str, maxsize: Optional[int] = 1024) -> None:
+        self.base = base
+        self.maxsize = maxsize
+        self._prefix_hash = hashlib.md5(str(_generate_uuid(base)).encode())
+        self._generate = lru_cache(maxsize=maxsize)(self._hash)
+
+    def __reduce__(self) -> Tuple[Type["UuidGenerator"], Tuple[str, Optional[int]]]:
+        """Pickle the generator by its arguments, as its cache and hash cannot be.
+
+        Returns:
+            The class and arguments to recreate the generator with an empty cache.
+        """
+        return type(self), (self.base, self.maxsize)
+
+    def _hash(self, value: str) -> UUID:
+        """Hash a value after the base, copying the hash state of the base.
+
+        Args:
+            value: Specific value utilized to generate UUID.
+
+        Returns:
+            The generated UUID
+        """
+        value_hash = self._prefix_hash.copy()
+        value_hash.update(str(value).encode())
+        return UUID(bytes=value_hash.digest())
+
+    def __call__(self, value: str) -> UUID:
+        """Generate the UUID of a value.
+
+        Args:
+            value: Specific value utilized to generate UUID.
+
+        Returns:
+            The generated UUID
+        """
+        return self._generate(value)
+
+    def cache_info(self) -> Any:
+        """Hit and miss statistics of the cache, as for `functools.lru_cache`."""
+        return self._generate.cache_info()
+
+    def cache_clear(self) -> None:
+        """Clear the cache and its statistics."""
+        self._generate.cache_clear()
+
+
+def _digests(prefix: str, values: Iterable[str]) -> Iterator[bytes]:
+    """Hash each value after the prefix, copying the hash state of the prefix.
+
+    Args:
+        prefix: The string prepended to every value.
+        values: The values to hash.
+
+    Yields:
+        The md5 digest of the prefix and each value.
+    """
+    copy_prefix_hash = hashlib.md5(prefix.encode()).copy
+    for value in values:
+        value_hash = copy_prefix_hash()
+        value_hash.update(str(value).encode())
+        yield value_hash.digest()
+
+
+def _digest_chunk(prefix: str, values: List[str]) -> bytes:
+    """Hash a chunk of values in the executor, see `_digests`.
+
+    Returns:
+        The concatenated digests, which are cheaper to send between processes
+        than `UUID` objects.
+    """
+    return b"".join(_digests(prefix, values))
+
+
+def _validate_chunksize(chunksize: int) -> None:
+    """Validate the chunksize argument of the bulk functions.
+
+    Raises:
+        ValueError: if chunksize is not positive.
+    """
+    if chunksize < 1:
+        raise ValueError(f"chunksize must be positive, got {chunksize}")
+
+
+def _digest_chunks(
+    base: str,
+    values: Iterable[str],
+    executor: Optional[Executor],
+    processes: bool,
+    chunksize: int,
+) -> Iterator[bytes]:
+    """Hash chunks of values, in the executor if requested.
+
+    Args:
+        base: Base or seed utilized to generate all UUIDs.
+        values: Specific values utilized to generate each UUID.
+        executor: The executor to hash chunks of values on, if any.
+        processes: Whether to use the shared process pool, if no executor is given.
+        chunksize: The number of values to hash at a time.
+
+    Raises:
+        ValueError: if chunksize is not positive.
+
+    Returns:
+        Iterator of the concatenated digests of each chunk, in order.
+    """
+    _validate_chunksize(chunksize)
+    prefix = str(_generate_uuid(base))
+    chunks = chunked(values, chunksize)
+    if executor is None and not processes:
+        return map(partial(_digest_chunk, prefix), chunks)
+    executor = executor or shared_executor(processes=True)
+    return executor.map(_digest_chunk, repeat(prefix), chunks)
+
+
+@overload
+def generate_uuids(
+    base: str,
+    values: Iterable[str],
+    out: None = None,
+    *,
+    executor: Optional[Executor] = None,
+    processes: bool = False,
+    chunksize: int = 10000,
+) -> Iterator[UUID]:
+    ...  # pragma: no cover
+
+
+@overload
+def generate_uuids(
+    base: str,
+    values: Iterable[str],
+    out: MutableSequence[Any],
+    *,
+    executor: Optional[Executor] = None,
+    processes: bool = False,
+    chunksize: int = 10000,
+) -> MutableSequence[Any]:
+    ...  # pragma: no cover
+
+
+def generate_uuids(
+    base: str,
+    values: Iterable[str],
+    out: Optional[MutableSequence[Any]] = None,
+    *,
+    executor: Optional[Executor] = None,
+    processes: bool = False,
+    chunksize: int = 10000,
+) -> Union[Iterator[UUID], MutableSequence[Any]]:
+    """Generate the predictable UUIDs of many values with the same base/seed.
+
+    Generates the same UUIDs as `generate_uuid`, without its per-call overhead,
+    hashing the base only once. Large inputs can be split into chunks, which are
+    hashed in parallel on an executor, such as the shared process pool.
+
+    Example:
+        ```Python
+        uuids = generate_uuids("secret_seed", ["facetnavn1", "facetnavn2"])
+        assert list(uuids) == [
+            generate_uuid("secret_seed", "facetnavn1"),
+            generate_uuid("secret_seed", "facetnavn2"),
+        ]
+
+        out = [None] * 1000000
+        generate_uuids("secret_seed", map(str, range(1000000)), out, processes=True)
+        ```
+
+    Args:
+        base: Base or seed utilized to generate all UUIDs.
+        values: Specific values utilized to generate each UUID.
+        out: Preallocated sequence to write the UUIDs into, in order, instead of
+            returning an iterator. Must be at least as long as `values`.
+        executor: The executor to hash chunks of values on. Note that all chunks
+            are submitted at once, so `values` is consumed up front.
+        processes: Whether to hash chunks of values on the shared process pool,
+            if no executor is given.
+        chunksize: The number of values to submit to the executor at a time.
+
+    Raises:
+        ValueError: if chunksize is not positive.
+
+    Returns:
+        Iterator of the generated UUIDs, or `out` if given.
+    """
+    digests: Iterable[bytes]
+    if executor is None and not processes:
+        _validate_chunksize(chunksize)
+        digests = _digests(str(_generate_uuid(base)), values)
+    else:
+        chunks = _digest_chunks(base, values, executor, processes, chunksize)
+        digests = (
+            chunk[start : start + 16]
+            for chunk in chunks
+            for start in range(0, len(chunk), 16)
+        )
+    uuids = map(partial(UUID, None), digests)
+    if out is None:
+        return uuids
+    for index, uuid in enumerate(uuids):
+        out[index] = uuid
+    return out
+
+
+def generate_uuid_bytes(
+    base: str,
+    values: Iterable[str],
+    out: Optional[Buffer] = None,
+    *,
+    executor: Optional[Executor] = None,
+    processes: bool = False,
+    chunksize: int = 10000,
+) -> Buffer:
+    """Generate the predictable UUIDs of many values, as contiguous raw bytes.
+
+    Like `generate_uuids`, but writes the 16 bytes of each UUID back to back,
+    instead of creating `UUID` objects, using a fraction of the memory. The
+    result can be handed to bulk loaders and columnar writers without copying.
+
+    Example:
+        ```Python
+        values = ["facetnavn1", "facetnavn2"]
+        data = generate_uuid_bytes("secret_seed", values)
+        assert UUID(bytes=bytes(data[16:32])) == generate_uuid(
+            "secret_seed", "facetnavn2"
+        )
+
+        out = memoryview(bytearray(16 * len(values)))
+        generate_uuid_bytes("secret_seed", values, out)
+        ```
+
+    Args:
+        base: Base or seed utilized to generate all UUIDs.
+        values: Specific values utilized to generate each UUID.
+        out: Preallocated, writable and contiguous buffer to write the UUIDs into,
+            such as a `bytearray`, a `memoryview` or a NumPy array, instead of
+            returning a new `bytearray`. Must be at least 16 bytes per value.
+        executor: The executor to hash chunks of values on.
+        processes: Whether to hash chunks of values on the shared process pool,
+            if no executor is given.
+        chunksize: The number of values to hash at a time.
+
+    Raises:
+        ValueError: if chunksize is not positive, or out is too small.
+
+    Returns:
+        `bytearray` of the UUIDs, or `out` if given.
+    """
+    chunks = _digest_chunks(base, values, executor, processes, chunksize)
+    if out is None:
+        return bytearray().join(chunks)
+    view = memoryview(out).cast("B")
+    start = 0
+    for chunk in chunks:
+        end = start + len(chunk)
+        if end > view.nbytes:
+            raise ValueError(f"out is too small, {view.nbytes} bytes")
+        view[start:end] = chunk
+        start = end
+    return out
+
+
+def generate_uuid_array(
+    base: str, values: Iterable[str], dtype: str = "V16", **kwargs: Any
+) -> Any:
+    """Generate the predictable UUIDs of many values, as a NumPy array.
+
+    The array shares its memory with the `bytearray` from `generate_uuid_bytes`.
+
+    Example:
+        ```Python
+        array = generate_uuid_array("secret_seed", ["facetnavn1", "facetnavn2"])
+        print(array.shape, array.dtype)  # --> (2,) |V16
+        assert UUID(bytes=array[0].tobytes()) == generate_uuid(
+            "secret_seed", "facetnavn1"
+        )
+        ```
+
+    Args:
+        base: Base or seed utilized to generate all UUIDs.
+        values: Specific values utilized to generate each UUID.
+        dtype: Either "V16" for an array of raw 16 byte values, or "uint8" for an
+            array of shape (len(values), 16). Byte strings ("S16") are not
+            supported, as NumPy strips their trailing NUL bytes on access.
+        kwargs: Passed on to `generate_uuid_bytes`.
+
+    Raises:
+        ValueError: if NumPy is not installed, or dtype is not supported.
+
+    Returns:
+        The NumPy array of the UUIDs.
+    """
+    if not _has_numpy:  # pragma: no cover
+        raise ValueError("'numpy' not installed!")
+    if dtype not in ("V16", "uint8"):
+        raise ValueError(f"dtype must be 'V16' or 'uint8', got {dtype!r}")
+    data = generate_uuid_bytes(base, values, **kwargs)
+    if dtype == "V16":
+        return numpy.frombuffer(data, dtype="V16")
+    return numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, 16)
+
+
+def uuid_generator(base: str, maxsize: Optional[int] = 1024) -> UuidGenerator:
     """Construct an UUID generator with a fixed base/seed.
 
     Example:
@@ -54,8 +400,9 @@ def uuid_generator(base: str) -> Callable[[str], UUID]:
 
     Args:
         base: Base or seed utilized to generate all UUIDs.
+        maxsize: Maximum number of UUIDs to cache, `None` for no limit.
 
     Returns:
-        Function which map strings to UUIDs.
+        Callable `UuidGenerator` which map strings to UUIDs.
     """
-    return partial(generate_uuid, base)
+    return UuidGenerator(base, maxsize)
@@ -1,12 +1,28 @@
 # SPDX-FileCopyrightText: 2021 Magenta ApS <https://magenta.dk>
 # SPDX-License-Identifier: MPL-2.0
+import hashlib
+import json
+import os
+import tempfile
 import time
-from functools import lru_cache
+from asyncio import ensure_future
+from asyncio import Future
+from asyncio import get_running_loop
+from asyncio import shield
+from dataclasses import dataclass
+from dataclasses import field
+from pathlib import Path
+from threading import Lock
+from threading import Timer
 from typing import Any
+from typing import cast
 from typing import Dict
 from typing import Optional
 from typing import Tuple
+from typing import Type
 from warnings import warn
+from weakref import finalize
+from weakref import ref
 
 
 try:
@@ -14,16 +30,59 @@ try:
     from pydantic import AnyHttpUrl
     from pydantic import BaseSettings
     from pydantic import Field
+    from pydantic import PrivateAttr
     from pydantic import root_validator
 except ImportError as err:  # pragma: no cover
     raise ImportError(f"{err.name} not found - token settings not imported")
 
+from .sync_to_async import sync_to_async
+
 
 # Exception
 class AuthError(Exception):
     """Raised when errors in authentication occurs."""
 
 
+@dataclass
+class _TokenState:
+    """Runtime token state of `TokenSettings`.
+
+    Not shared with copies of the settings, nor sent along when pickling them,
+    as the locks, timer and task cannot be, and the expiry time of the token is
+    only meaningful in this process.
+    """
+
+    token: Optional[Tuple[float, str]] = None
+    token_lock: Lock = field(default_factory=Lock)
+    refresh_lock: Lock = field(default_factory=Lock)
+    refresh_timer: Optional[Timer] = None
+    refresh_closed: bool = False
+    refresh_finalizer: Optional[finalize] = None
+    bearer_task: Optional["Future[str]"] = None
+
+    def __reduce__(self) -> Tuple[Type["_TokenState"], Tuple[()]]:
+        return _TokenState, ()
+
+    def close_refresh(self) -> None:
+        """Cancel background renewal of the token, if scheduled."""
+        with self.refresh_lock:
+            self.refresh_closed = True
+            if self.refresh_timer is not None:
+                self.refresh_timer.cancel()
+
+
+def _refresh_weakly(settings_ref: "ref[TokenSettings]") -> None:
+    """Renew the token in the background, unless the settings are gone.
+
+    Args:
+        settings_ref: Weak reference to the settings, so the background renewal
+            does not keep them alive.
+    """
+    settings = settings_ref()
+    if settings is not None:
+        settings._refresh()
+
+
 # Settings
 
 
@@ -41,8 +100,21 @@ class TokenSettings(BaseSettings):
         response.raise_for_status()
         print(response.json())
         ```
+
+    *Note: Set `oidc_token_cache_dir` to cache tokens on disk, so short-lived
+           processes using the same `auth_server`, `auth_realm` and
+           `client_id` reuse a still valid token, rather than fetching one.*
+
+    *Note: Set `oidc_token_refresh_ahead` to renew tokens on a background thread
+           before they expire, so `get_headers` does not wait for the
+           authentication server while a valid token exists. Renewal stops
+           when `close` is called, when leaving the settings used as a context
+           manager, or when the settings are garbage collected.*
     """
 
+    # Allow weak references, used by the background renewal
+    __slots__ = ("__weakref__",)
+
     client_id: str = "mo"
     client_secret: Optional[str]  # in the future, this should be required
     auth_realm: str = "mo"
@@ -51,10 +123,56 @@ class TokenSettings(BaseSettings):
 
     # Re-new token this many seconds before it actually expires
     oidc_token_lifespan_offset: int = 30
+    # Timeout in seconds for each request to the authentication server
+    auth_timeout: float = 10
+    # Renew token in the background this many seconds before it would otherwise
+    # be renewed, or not at all if unset
+    oidc_token_refresh_ahead: Optional[float] = None
+    # Directory to share tokens between processes in, or no sharing if unset
+    oidc_token_cache_dir: Optional[Path] = None
+
+    _session: Optional[requests.Session] = PrivateAttr(None)
+    _state: _TokenState = PrivateAttr(default_factory=_TokenState)
 
     class Config:
         frozen = True
 
+    def __init__(
+        self, *args: Any, session: Optional[requests.Session] = None, **kwargs: Any
+    ) -> None:
+        """Initialize settings, optionally with a session to fetch tokens with.
+
+        Args:
+            session: Session to use for requests to the authentication server,
+                instead of creating one on first use.
+        """
+        super().__init__(*args, **kwargs)
+        self._session = session
+
+    def copy(self, **kwargs: Any) -> "TokenSettings":  # type: ignore
+        """Duplicate the settings, as `BaseModel.copy`, but without the token.
+
+        Args:
+            kwargs: Passed on to `BaseModel.copy`.
+
+        Returns:
+            The new settings.
+        """
+        settings = super().copy(**kwargs)
+        settings._state = _TokenState()
+        return settings
+
+    @property
+    def session(self) -> requests.Session:
+        """Session used for requests to the authentication server.
+
+        Token refreshes reuse its pooled keep-alive connections, rather than
+        opening a new connection for each request.
+        """
+        if self._session is None:
+            self._session = requests.Session()
+        return self._session
+
     @root_validator
     def validate_settings(cls, values: Dict[str, Any]) -> Dict[str, Any]:
         """Validate token settings by checking that either `client_secret`,
@@ -86,7 +204,6 @@ class TokenSettings(BaseSettings):
             )
         return values
 
-    @lru_cache(maxsize=None)
     def _fetch_keycloak_token(self) -> Tuple[float, str]:
         """Fetch a keycloak token and its expiry time.
 
@@ -108,7 +225,9 @@ class TokenSettings(BaseSettings):
             "client_secret": self.client_secret,
         }
         try:
-            response = requests.post(token_url, data=payload)
+            response = self.session.post(
+                token_url, data=payload, timeout=self.auth_timeout
+            )
             response.raise_for_status()
         except requests.RequestException as err:
             raise AuthError(f"Failed to get Keycloak token: {err}")
@@ -117,10 +236,83 @@ class TokenSettings(BaseSettings):
         token: str = response_payload["access_token"]
         return time.monotonic() + float(expires), token
 
+    def _new_token(self) -> Tuple[float, str]:
+        """Fetch a new keycloak token, storing it in the token cache if enabled.
+
+        Raises:
+            AuthError: If no client secret is given or the response from
+                the authentication server raises an error.
+
+        Returns:
+            Tuple of token-expiry time in seconds and the token itself.
+        """
+        token = self._fetch_keycloak_token()
+        if self.oidc_token_cache_dir is not None:
+            self._store_cached_token(token)
+        return token
+
+    def _token_cache_path(self) -> Path:
+        """Path of the token cache file of these settings."""
+        key = f"{self.auth_server}|{self.auth_realm}|{self.client_id}"
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return cast(Path, self.oidc_token_cache_dir) / f"{digest}.json"
+
+    def _load_cached_token(self) -> Optional[Tuple[float, str]]:
+        """Load a token from the token cache, if enabled and not due for renewal.
+
+        Cache files readable by other users are ignored.
+
+        Returns:
+            Tuple of token-expiry time in seconds and the token itself, or `None`
+            if no usable token is cached.
+        """
+        if self.oidc_token_cache_dir is None:
+            return None
+        try:
+            with open(self._token_cache_path(), encoding="utf-8") as cache_file:
+                stat = os.fstat(cache_file.fileno())
+                if stat.st_mode & 0o077 or stat.st_uid != os.getuid():
+                    return None
+                cached: Dict[str, Any] = json.load(cache_file)
+            # Expiry is stored as wall-clock time, which is shared by processes
+            expires = time.monotonic() + float(cached["expires"]) - time.time()
+            token = str(cached["token"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if expires - self.oidc_token_lifespan_offset < time.monotonic():
+            return None
+        return expires, token
+
+    def _store_cached_token(self, token: Tuple[float, str]) -> None:
+        """Store a token in the token cache, atomically and readable only by us.
+
+        Failing to store the token is ignored, as the cache is only an
+        optimization.
+
+        Args:
+            token: Tuple of token-expiry time in seconds and the token itself.
+        """
+        expires = time.time() + token[0] - time.monotonic()
+        cache_dir = cast(Path, self.oidc_token_cache_dir)
+        try:
+            cache_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+            # Created readable only by us, and renamed into place when complete
+            fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as temp_file:
+                    json.dump({"expires": expires, "token": token[1]}, temp_file)
+                os.replace(temp_path, self._token_cache_path())
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+        except OSError:
+            pass
+
     def _fetch_bearer(self, force: bool = False, logger: Any = None) -> str:
         """Fetch a Keycloak bearer token.
 
-        Automatically refetches the token after it expires.
+        Automatically refetches the token after it expires, or before it
+        expires, in the background, if `oidc_token_refresh_ahead` is set.
 
         Args:
             force: always refresh token if true
@@ -133,13 +325,104 @@ class TokenSettings(BaseSettings):
         Returns:
             The Bearer token itself.
         """
-        expires, token = self._fetch_keycloak_token()
+        token = self._state.token
+        if token is None:
+            with self._state.token_lock:
+                if self._state.token is None:
+                    self._state.token = self._load_cached_token() or self._new_token()
+                token = self._state.token
+        expires = token[0]
         if force or expires - self.oidc_token_lifespan_offset < time.monotonic():
-            self._fetch_keycloak_token.cache_clear()
-            expires, token = self._fetch_keycloak_token()
+            token = self._renew_token(token, force, logger)
+        if self.oidc_token_refresh_ahead is not None:
+            self._schedule_refresh(token[0])
+        return "Bearer " + token[1]
+
+    def _renew_token(
+        self, token: Tuple[float, str], force: bool, logger: Any
+    ) -> Tuple[float, str]:
+        """Renew the token once, no matter how many threads find it due.
+
+        Threads finding a renewal in progress keep using the token while it is
+        still valid, and otherwise wait for the renewed token.
+
+        Args:
+            token: The token found due for renewal.
+            force: always wait for a renewed token if true
+            logger: logger used for logging token refresh info
+
+        Raises:
+            AuthError: If no client secret is given or the response from
+                the authentication server raises an error.
+
+        Returns:
+            The renewed token, or the still-valid token being renewed.
+        """
+        if not self._state.token_lock.acquire(blocking=False):
+            if not force and token[0] > time.monotonic():
+                return token
+            self._state.token_lock.acquire()
+        try:
+            if self._state.token is not token:
+                # Renewed by another thread while waiting
+                return cast(Tuple[float, str], self._state.token)
+            token = self._state.token = self._new_token()
             if logger:
-                logger.debug("New token fetched", expires=expires, token=token)
-        return "Bearer " + token
+                logger.debug("New token fetched", expires=token[0], token=token[1])
+            return token
+        finally:
+            self._state.token_lock.release()
+
+    def _schedule_refresh(self, expires: float) -> None:
+        """Schedule renewal of the token in the background, unless scheduled.
+
+        Args:
+            expires: Expiry time of the current token.
+        """
+        with self._state.refresh_lock:
+            if self._state.refresh_closed or self._state.refresh_timer is not None:
+                return
+            renew_at = expires - self.oidc_token_lifespan_offset
+            delay = renew_at - cast(float, self.oidc_token_refresh_ahead)
+            timer = Timer(
+                max(delay - time.monotonic(), 0), _refresh_weakly, (ref(self),)
+            )
+            timer.daemon = True
+            self._state.refresh_timer = timer
+            if self._state.refresh_finalizer is None:
+                self._state.refresh_finalizer = finalize(
+                    self, self._state.close_refresh
+                )
+        timer.start()
+
+    def _refresh(self) -> None:
+        """Renew the token in the background, and schedule the next renewal.
+
+        If renewal fails, the token is renewed when it would otherwise be, and
+        the background renewal is scheduled again on the next use.
+        """
+        try:
+            with self._state.token_lock:
+                self._state.token = token = self._new_token()
+        except Exception:
+            with self._state.refresh_lock:
+                self._state.refresh_timer = None
+            return
+        with self._state.refresh_lock:
+            self._state.refresh_timer = None
+        self._schedule_refresh(token[0])
+
+    def close(self) -> None:
+        """Cancel background renewal of the token, if scheduled."""
+        self._state.close_refresh()
+
+    def __enter__(self) -> "TokenSettings":
+        """Use the settings until leaving the context, see `close`."""
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        """Cancel background renewal of the token, see `close`."""
+        self.close()
 
     def get_headers(self, force: bool = False, logger: Any = None) -> Dict[str, str]:
         """Get authorization headers based on configured tokens.
@@ -167,3 +450,64 @@ class TokenSettings(BaseSettings):
         if self.client_secret:
             headers["Authorization"] = self._fetch_bearer(force, logger)
         return headers
+
+    async def _afetch_bearer(self, force: bool = False, logger: Any = None) -> str:
+        """Fetch a Keycloak bearer token, without blocking the event-loop.
+
+        A valid token is returned directly. Otherwise, like `_fetch_bearer`,
+        run on the shared thread pool. Concurrent calls share a single call in
+        flight, so at most one request is made to the authentication server at
+        a time, no matter the number of callers.
+
+        Args:
+            force: always refresh token if true, unless a call is in flight
+            logger: logger used for logging token refresh info
+
+        Raises:
+            AuthError: If no client secret is given or the response from
+                the authentication server raises an error.
+
+        Returns:
+            The Bearer token itself.
+        """
+        token = self._state.token
+        if (
+            not force
+            and token is not None
+            and token[0] - self.oidc_token_lifespan_offset >= time.monotonic()
+        ):
+            if self.oidc_token_refresh_ahead is not None:
+                self._schedule_refresh(token[0])
+            return "Bearer " + token[1]
+        task = self._state.bearer_task
+        if task is None or task.done() or task.get_loop() is not get_running_loop():
+            task = ensure_future(sync_to_async(self._fetch_bearer)(force, logger))
+            self._state.bearer_task = task
+        # Do not cancel the call shared with other callers if cancelled
+        return await shield(task)
+
+    async def aget_headers(
+        self, force: bool = False, logger: Any = None
+    ) -> Dict[str, str]:
+        """Get authorization headers based on configured tokens, asynchronously.
+
+        Like `get_headers`, but does not block the event-loop while the token is
+        refreshed, and concurrent calls share a single refresh.
+
+        Args:
+            force: always refresh token if true
+            logger: logger used for logging token refresh info
+
+        Raises:
+            AuthError: If `client_secret` is given, but the response from the
+                authentication server raises an error.
+
+        Returns:
+            Header dictionary.
+        """
+        headers: Dict[str, str] = {}
+        if self.saml_token:
+            headers["Session"] = self.saml_token
+        if self.client_secret:
+            headers["Authorization"] = await self._afetch_bearer(force, logger)
+        return headers
@@ -0,0 +1,109 @@
+# SPDX-FileCopyrightText: 2023 Magenta ApS <https://magenta.dk>
+# SPDX-License-Identifier: MPL-2.0
+from asyncio import CancelledError
+from asyncio import get_running_loop
+from concurrent.futures import Executor
+from contextvars import copy_context
+from functools import partial
+from functools import wraps
+from threading import Event
+from typing import Any
+from typing import Callable
+from typing import Coroutine
+from typing import Optional
+from typing import overload
+from typing import TypeVar
+from typing import Union
+
+from .asyncio_utils import shared_executor
+
+CallableReturnType = TypeVar("CallableReturnType")
+SyncFunction = Callable[..., CallableReturnType]
+AsyncFunction = Callable[..., Coroutine[Any, Any, CallableReturnType]]
+
+
+@overload
+def sync_to_async(
+    func: SyncFunction[CallableReturnType],
+) -> AsyncFunction[CallableReturnType]:
+    ...  # pragma: no cover
+
+
+@overload
+def sync_to_async(
+    *, cancellable: bool = False, executor: Optional[Executor] = None
+) -> Callable[[SyncFunction[CallableReturnType]], AsyncFunction[CallableReturnType]]:
+    ...  # pragma: no cover
+
+
+def sync_to_async(
+    func: Optional[SyncFunction[CallableReturnType]] = None,
+    *,
+    cancellable: bool = False,
+    executor: Optional[Executor] = None,
+) -> Union[
+    AsyncFunction[CallableReturnType],
+    Callable[[SyncFunction[CallableReturnType]], AsyncFunction[CallableReturnType]],
+]:
+    """Function decorator to run a blocking function without blocking the event-loop.
+
+    Calls run on the process-wide shared thread pool from
+    `ra_utils.asyncio_utils.shared_executor`, whose size can be set using
+    `ra_utils.asyncio_utils.configure_shared_executor`, so all blocking calls
+    share one bounded pool. Context variables are propagated to the thread.
+
+    Threads cannot be interrupted, so cancelling the caller does not stop a call
+    which has already started. With `cancellable` set, the function is instead
+    given a `cancelled` keyword argument, a `threading.Event` which is set when
+    the caller is cancelled, allowing the function to stop early.
+
+    Example:
+        ```Python
+        @sync_to_async
+        def read_settings(path: str) -> str:
+            with open(path) as settings_file:
+                return settings_file.read()
+
+        print(await read_settings("settings.json"))
+
+        @sync_to_async(cancellable=True)
+        def export(rows: List[Row], cancelled: threading.Event) -> None:
+            for row in rows:
+                if cancelled.is_set():
+                    return
+                write(row)
+        ```
+
+    Args:
+        func: The synchronous function to wrap.
+        cancellable: Whether to pass a `cancelled` event to the function.
+        executor: The executor to run on, instead of the shared thread pool.
+
+    Returns:
+        The newly generated asynchronous function wrapping the sync one, or a
+        decorator creating it, if no function is given.
+    """
+
+    def decorator(
+        func: SyncFunction[CallableReturnType],
+    ) -> AsyncFunction[CallableReturnType]:
+        @wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> CallableReturnType:
+            cancelled = Event()
+            if cancellable:
+                kwargs["cancelled"] = cancelled
+            call = partial(copy_context().run, func, *args, **kwargs)
+            future = get_running_loop().run_in_executor(
+                executor or shared_executor(), call
+            )
+            try:
+                return await future
+            except CancelledError:
+                cancelled.set()
+                raise
+
+        return wrapper
+
+    if func is None:
+        return decorator
+    return decorator(func)
@@ -1,21 +1,101 @@
 # SPDX-FileCopyrightText: 2021 Magenta ApS <https://magenta.dk>
 # SPDX-License-Identifier: MPL-2.0
+from asyncio import AbstractEventLoop
 from asyncio import get_event_loop
+from asyncio import get_running_loop
 from asyncio import iscoroutinefunction
 from asyncio import new_event_loop
-from functools import partial
+from asyncio import run_coroutine_threadsafe
+from asyncio import wrap_future
 from functools import wraps
+from inspect import getattr_static
+from inspect import isasyncgenfunction
+from threading import local
+from types import MethodType
 from types import TracebackType
 from typing import Any
+from typing import AsyncIterator
 from typing import Awaitable
 from typing import Callable
+from typing import cast
+from typing import Coroutine
+from typing import Iterator
 from typing import Optional
 from typing import Type
 from typing import TypeVar
 from typing import Union
+from weakref import finalize
+
+from .async_to_sync import _in_running_loop
+from .async_to_sync import create_event_loop
+from .async_to_sync import EventLoopThread
+from .async_to_sync import uvloop_enabled
 
 
 CoroutineReturnType = TypeVar("CoroutineReturnType")
+IteratorItemType = TypeVar("IteratorItemType")
+
+
+# The uvloop event-loop of each thread, shared by its `Syncable` instances
+_uvloops = local()
+
+
+def _thread_uvloop() -> AbstractEventLoop:
+    """Get the uvloop event-loop of the current thread, creating it if needed.
+
+    Like `asyncio.get_event_loop`, this reuses one loop per thread, rather than
+    leaking a loop, and its file descriptors, per instance.
+
+    Returns:
+        The uvloop event-loop.
+    """
+    loop: Optional[AbstractEventLoop] = getattr(_uvloops, "loop", None)
+    if loop is None or loop.is_closed():
+        loop = _uvloops.loop = create_event_loop(use_uvloop=True)
+    return loop
+
+
+async def _anext(iterator: AsyncIterator[IteratorItemType]) -> IteratorItemType:
+    """Coroutine awaiting the next item of an async iterator."""
+    return await iterator.__anext__()
+
+
+async def _aclose(iterator: AsyncIterator[Any]) -> None:
+    """Coroutine closing an async iterator, if it can be closed."""
+    aclose = getattr(iterator, "aclose", None)
+    if aclose is not None:
+        await aclose()
+
+
+class _SyncableMethod:
+    """Descriptor wrapping a coroutine or async generator function of `Syncable`.
+
+    The wrapper is created once, when the class is created. Accessing it on an
+    instance only binds it, like any other method, while accessing it on the
+    class returns the wrapped function itself.
+
+    Args:
+        attribute: The function, or the `staticmethod` or `classmethod` wrapping
+            it.
+        runner: Name of the `Syncable` method to call the function with.
+    """
+
+    def __init__(self, attribute: Any, runner: str) -> None:
+        self.attribute = attribute
+
+        @wraps(getattr(attribute, "__func__", attribute))
+        def run_method(
+            instance: "Syncable", *args: Any, **kwargs: Optional[Any]
+        ) -> Any:
+            method = attribute.__get__(instance, type(instance))
+            return getattr(instance, runner)(method, *args, **kwargs)
+
+        self.run_method = run_method
+
+    def __get__(self, instance: Any, owner: Optional[type] = None) -> Any:
+        if instance is None:
+            return self.attribute.__get__(None, owner)
+        return MethodType(self.run_method, instance)
 
 
 class Syncable:
@@ -23,9 +103,19 @@ class Syncable:
 
     Must be given before the async class in inheritance hierarchy.
 
-    *Note: Works by overridding `__getattribute__` to check for coroutine lookups
-           and wrapping them in `asyncio.loop.run_until_complete` if an active
-           event-loop is not detected.*
+    *Note: Works by wrapping the coroutine functions of subclasses when they are
+           created, in `asyncio.loop.run_until_complete` if an active event-loop
+           is not detected when they are called. Async generator functions and
+           `__aiter__` are likewise turned into iterators, running the loop
+           for one item at a time.*
+
+    *Note: Set `use_uvloop` on the subclass, or the `RA_UTILS_UVLOOP` environment
+           variable, to run on uvloop when it is installed.*
+
+    *Note: Set `threadsafe` on the subclass to run all calls on an event-loop
+           thread owned by the instance, allowing it to be shared between
+           threads, with calls from each thread running concurrently on the
+           loop. Awaiting calls from another event-loop also runs them there.*
 
     Example:
         Basic usage:
@@ -83,8 +173,43 @@ class Syncable:
         ```
     """
 
+    # Whether to create the event-loop using uvloop, see `create_event_loop`
+    use_uvloop: Optional[bool] = None
+    # Whether to run all calls on an event-loop thread owned by the instance
+    threadsafe: bool = False
+    __runner: Optional[EventLoopThread] = None
+
+    def __init_subclass__(cls, **kwargs: Any) -> None:
+        """Wrap the async functions of the subclass, once at class creation."""
+        super().__init_subclass__(**kwargs)
+        for name in dir(cls):
+            attribute = getattr_static(cls, name)
+            if isinstance(attribute, _SyncableMethod):
+                continue
+            if attribute is vars(Syncable).get(name):
+                continue
+            function = getattr(cls, name, None)
+            if iscoroutinefunction(function):
+                runner = "_Syncable__run_coroutine"
+            elif isasyncgenfunction(function):
+                runner = "_Syncable__run_async_generator"
+            else:
+                continue
+            setattr(cls, name, _SyncableMethod(attribute, runner))
+        if hasattr(cls, "__aiter__") and "__iter__" not in vars(cls):
+            cls.__iter__ = Syncable.__iterate_aiter  # type: ignore
+
     def __init__(self, *args: Any, **kwargs: Optional[Any]) -> None:
         super().__init__(*args, **kwargs)  # type: ignore
+        if self.threadsafe:
+            self.__runner = EventLoopThread(
+                name=f"{type(self).__name__}-event-loop", use_uvloop=self.use_uvloop
+            )
+            finalize(self, self.__runner.stop)
+            return
+        if uvloop_enabled(self.use_uvloop) and not _in_running_loop():
+            self.__loop = _thread_uvloop()
+            return
         try:
             self.__loop = get_event_loop()
         except RuntimeError:
@@ -107,11 +232,19 @@ class Syncable:
             return self.__aexit__(exc_type, exc_value, exc_traceback)  # type: ignore
         raise AttributeError("__exit__")
 
+    def __iterate_aiter(self) -> Iterator[Any]:
+        """Iterate `__aiter__`, installed as `__iter__` of subclasses having it."""
+        iterator = self.__aiter__()  # type: ignore
+        if isinstance(iterator, Iterator):
+            # Already synchronized, as `__aiter__` is an async generator
+            return iterator
+        return cast(Iterator[Any], self.__run_async_iterator(iterator))
+
     def __run_coroutine(
         self,
-        coroutine: Callable[..., Awaitable[CoroutineReturnType]],
+        coroutine: Callable[..., Coroutine[Any, Any, CoroutineReturnType]],
         *args: Any,
-        **kwargs: Optional[Any]
+        **kwargs: Optional[Any],
     ) -> Union[Awaitable[CoroutineReturnType], CoroutineReturnType]:
         """Call coroutine if event-loop is running, call synchronized otherwise.
 
@@ -121,24 +254,110 @@ class Syncable:
         Returns:
             Awaitable if coroutine was executed directly, result otherwise.
         """
+        if self.__runner is not None:
+            return self.__run_threadsafe(coroutine(*args, **kwargs))
         if self.__loop.is_running():
             return coroutine(*args, **kwargs)
         return self.__loop.run_until_complete(coroutine(*args, **kwargs))
 
-    def __getattribute__(self, name: str) -> Any:
-        """Implementation of `__getattribute__` with special case for coroutines.
+    def __run_threadsafe(
+        self, coroutine: Coroutine[Any, Any, CoroutineReturnType]
+    ) -> Union[Awaitable[CoroutineReturnType], CoroutineReturnType]:
+        """Run coroutine on the event-loop thread owned by the instance.
 
         Args:
-            name: Name of the attribute to read.
+            coroutine: The coroutine to execute.
 
         Returns:
-            Exactly the same as `__getattribute__` normally does, unless the attribute
-            is a coroutine, in which case a wrapped version is returned. Wrapped with
-            `__run_coroutine`, to handle sync-calls outside of an active event-loop.
+            Awaitable if called from a running event-loop, result otherwise.
         """
-        attribute = getattr(super(), name, None)
-        if not attribute:
-            return object.__getattribute__(self, name)
-        if iscoroutinefunction(attribute):
-            return wraps(attribute)(partial(self.__run_coroutine, attribute))
-        return attribute
+        runner = cast(EventLoopThread, self.__runner)
+        try:
+            running_loop = get_running_loop()
+        except RuntimeError:
+            return runner.run(coroutine)
+        if running_loop is runner.loop:
+            return coroutine
+        return wrap_future(run_coroutine_threadsafe(coroutine, runner.loop))
+
+    def __run_async_generator(
+        self,
+        async_generator: Callable[..., AsyncIterator[IteratorItemType]],
+        *args: Any,
+        **kwargs: Optional[Any],
+    ) -> Union[AsyncIterator[IteratorItemType], Iterator[IteratorItemType]]:
+        """Call async generator, synchronizing it if event-loop is not running.
+
+        Args:
+            async_generator: The async generator function to call.
+
+        Returns:
+            Async iterator if event-loop is running, iterator otherwise.
+        """
+        return self.__run_async_iterator(async_generator(*args, **kwargs))
+
+    def __run_async_iterator(
+        self, iterator: AsyncIterator[IteratorItemType]
+    ) -> Union[AsyncIterator[IteratorItemType], Iterator[IteratorItemType]]:
+        """Synchronize async iterator if event-loop is not running.
+
+        Args:
+            iterator: The async iterator to synchronize.
+
+        Returns:
+            Async iterator if event-loop is running, iterator otherwise.
+        """
+        if self.__runner is None:
+            if self.__loop.is_running():
+                return iterator
+            return self.__iterate(iterator)
+        if not _in_running_loop():
+            return self.__iterate(iterator)
+        if get_running_loop() is self.__runner.loop:
+            return iterator
+        return self.__aiterate(iterator)
+
+    def __iterate(
+        self, iterator: AsyncIterator[IteratorItemType]
+    ) -> Iterator[IteratorItemType]:
+        """Iterate async iterator synchronously, running one step at a time.
+
+        Args:
+            iterator: The async iterator to iterate.
+
+        Yields:
+            The items of the async iterator.
+        """
+        try:
+            while True:
+                try:
+                    item = self.__run_coroutine(_anext, iterator)
+                except StopAsyncIteration:
+                    return
+                yield cast(IteratorItemType, item)
+        finally:
+            self.__run_coroutine(_aclose, iterator)
+
+    async def __aiterate(
+        self, iterator: AsyncIterator[IteratorItemType]
+    ) -> AsyncIterator[IteratorItemType]:
+        """Iterate async iterator on the event-loop thread owned by the instance.
+
+        Args:
+            iterator: The async iterator to iterate.
+
+        Yields:
+            The items of the async iterator.
+        """
+        try:
+            while True:
+                try:
+                    item = await cast(
+                        Awaitable[IteratorItemType],
+                        self.__run_coroutine(_anext, iterator),
+                    )
+                except StopAsyncIteration:
+                    return
+                yield item
+        finally:
+            await cast(Awaitable[None], self.__run_coroutine(_aclose, iterator))
@@ -1,12 +1,25 @@
 # SPDX-FileCopyrightText: 2021 Magenta ApS <https://magenta.dk>
 # SPDX-License-Identifier: MPL-2.0
+import asyncio
+from asyncio import AbstractEventLoop
+from asyncio import get_running_loop
 from asyncio import iscoroutinefunction
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 from unittest import TestCase
 
 import hypothesis.strategies as st
 from hypothesis import given
 
+try:
+    import uvloop
+except ImportError:  # pragma: no cover
+    uvloop = None  # type: ignore
+
 from ra_utils.async_to_sync import async_to_sync
+from ra_utils.async_to_sync import background_loop
+from ra_utils.async_to_sync import create_event_loop
+from ra_utils.async_to_sync import EventLoopThread
 
 
 @async_to_sync
@@ -18,6 +31,15 @@ async def async_add(a: int, b: int) -> int:
     return a + b
 
 
+@async_to_sync(persistent=True)
+async def persistent_add(a: int, b: int) -> int:
+    return a + b
+
+
+async def current_loop() -> AbstractEventLoop:
+    return get_running_loop()
+
+
 class AsyncToSyncTests(TestCase):
     """Test the async to sync decorator works as expected."""
 
@@ -34,3 +56,123 @@ class AsyncToSyncTests(TestCase):
 
         result = async_to_sync(async_add)(a, b)
         self.assertEqual(result, expected)
+
+    @given(st.integers(), st.integers())
+    def test_persistent_add(self, a: int, b: int):
+        self.assertFalse(iscoroutinefunction(persistent_add))
+        self.assertEqual(persistent_add(a, b), a + b)
+        self.assertEqual(async_to_sync(persistent=True)(async_add)(a, b), a + b)
+
+    def test_persistent_loop_reused(self):
+        persistent_loop = async_to_sync(persistent=True)(current_loop)
+        per_call_loop = async_to_sync(current_loop)
+
+        loop = persistent_loop()
+        self.assertIs(loop, background_loop.loop)
+        self.assertIs(persistent_loop(), loop)
+        self.assertIsNot(per_call_loop(), per_call_loop())
+
+        # Calls from other threads run on the same loop
+        with ThreadPoolExecutor(4) as executor:
+            loops = list(executor.map(lambda _: persistent_loop(), range(20)))
+        self.assertTrue(all(other is loop for other in loops))
+
+    def test_event_loop_thread(self):
+        runner = EventLoopThread()
+        loop = runner.loop
+        self.assertEqual(runner.run(asyncio.sleep(0, result=5)), 5)
+
+        with self.assertRaisesRegex(ValueError, "Oh no"):
+            runner.run(self._fail())
+
+        # Blocking from the loop thread itself runs on a temporary thread instead
+        async def nested() -> int:
+            return runner.run(asyncio.sleep(0, result=7))
+
+        self.assertEqual(runner.run(nested()), 7)
+
+        runner.stop()
+        self.assertTrue(loop.is_closed())
+        runner.stop()  # Stopping twice is fine
+
+        # Restarted on next use
+        self.assertEqual(runner.run(asyncio.sleep(0, result=6)), 6)
+        self.assertIsNot(runner.loop, loop)
+        runner.stop()
+
+    def test_event_loop_thread_stop_cancels_tasks(self):
+        runner = EventLoopThread()
+        cancelled = []
+
+        async def forever() -> None:
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        future = asyncio.run_coroutine_threadsafe(forever(), runner.loop)
+        runner.stop()
+        self.assertEqual(cancelled, [True])
+        self.assertTrue(future.cancelled())
+
+    @staticmethod
+    async def _fail() -> None:
+        raise ValueError("Oh no")
+
+    def test_inside_running_loop(self):
+        async def caller(a: int, b: int) -> int:
+            # Called from a running loop, as from Jupyter or an async handler
+            return sync_add(a, b)
+
+        self.assertEqual(asyncio.run(caller(1, 2)), 3)
+
+    def test_nested(self):
+        @async_to_sync
+        async def inner(a: int) -> int:
+            await asyncio.sleep(0)
+            return a * 2
+
+        @async_to_sync
+        async def outer(a: int) -> int:
+            return inner(a) + 1
+
+        @async_to_sync(persistent=True)
+        async def persistent_outer(a: int) -> int:
+            return outer(a) + inner(a)
+
+        self.assertEqual(outer(5), 11)
+        self.assertEqual(persistent_outer(5), 21)
+
+    def test_inside_running_loop_other_tasks(self):
+        async def caller() -> int:
+            other = asyncio.ensure_future(asyncio.sleep(0, result=1))
+            # Blocks the calling loop, but does not break the other task
+            result = sync_add(1, 2)
+            return result + await other
+
+        self.assertEqual(asyncio.run(caller()), 4)
+
+    def test_create_event_loop(self):
+        loop_type = uvloop.Loop if uvloop else type(asyncio.new_event_loop())
+        default_type = type(asyncio.new_event_loop())
+
+        with mock.patch.dict("os.environ", {"RA_UTILS_UVLOOP": ""}):
+            self.assertIsInstance(create_event_loop(), default_type)
+            self.assertIsInstance(create_event_loop(use_uvloop=True), loop_type)
+        with mock.patch.dict("os.environ", {"RA_UTILS_UVLOOP": "true"}):
+            self.assertIsInstance(create_event_loop(), loop_type)
+            self.assertIsInstance(create_event_loop(use_uvloop=False), default_type)
+
+    def test_uvloop(self):
+        loop_type = uvloop.Loop if uvloop else type(asyncio.new_event_loop())
+        uvloop_current_loop = async_to_sync(use_uvloop=True)(current_loop)
+        self.assertIsInstance(uvloop_current_loop(), loop_type)
+        self.assertEqual(async_to_sync(use_uvloop=True)(async_add)(1, 2), 3)
+
+        @async_to_sync(use_uvloop=True)
+        async def leave_task_behind() -> None:
+            asyncio.ensure_future(asyncio.sleep(10))
+
+        # Outstanding tasks are cancelled, like asyncio.run
+        leave_task_behind()
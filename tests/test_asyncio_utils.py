@@ -1,11 +1,46 @@
 # SPDX-FileCopyrightText: 2021 Magenta ApS <https://magenta.dk>
 # SPDX-License-Identifier: MPL-2.0
 import asyncio
+import gc
+import heapq
+import sys
+import threading
+import time
+import weakref
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any
+from typing import AsyncIterator
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
 from typing import Type
 
 import pytest
+from prometheus_client import CollectorRegistry
 
+from ra_utils.asyncio_utils import AdaptiveConcurrency
+from ra_utils.asyncio_utils import as_completed_with_concurrency
+from ra_utils.asyncio_utils import BatchLoader
+from ra_utils.asyncio_utils import ConcurrencyMetrics
+from ra_utils.asyncio_utils import configure_shared_executor
+from ra_utils.asyncio_utils import gather_in_executor
 from ra_utils.asyncio_utils import gather_with_concurrency
+from ra_utils.asyncio_utils import Pipeline
+from ra_utils.asyncio_utils import PipelineStage
+from ra_utils.asyncio_utils import RateLimiter
+from ra_utils.asyncio_utils import released_slot
+from ra_utils.asyncio_utils import RetryPolicy
+from ra_utils.asyncio_utils import shared_executor
+from ra_utils.asyncio_utils import with_batching
+from ra_utils.asyncio_utils import with_concurrency
+from ra_utils.asyncio_utils import with_rate_limit
+from ra_utils.asyncio_utils import with_retry
 
 
 @pytest.mark.parametrize(
@@ -101,3 +136,1462 @@ async def test_gather_with_concurrency(parallel: int, num_tasks: int) -> None:
     result = await gather_with_concurrency(parallel, *tasks)
     assert len(save) == min(parallel, num_tasks)
     assert len(result) == num_tasks
+
+
+async def test_as_completed_with_concurrency_invalid_input() -> None:
+    """Test that invalid inputs are rejected.
+
+    Returns:
+        None
+    """
+    with pytest.raises(ValueError):
+        await as_completed_with_concurrency(0, []).__anext__()
+    with pytest.raises(TypeError):
+        await as_completed_with_concurrency("1", []).__anext__()  # type: ignore
+    with pytest.raises(ValueError):
+        await as_completed_with_concurrency(5, [], ordered=True, window=4).__anext__()
+
+
+@pytest.mark.parametrize("is_async", [False, True])
+@pytest.mark.parametrize(
+    "parallel,num_tasks,ordered",
+    [
+        (1, 0, False),
+        (1, 100, False),
+        (1000, 5, False),
+        (5, 1000, False),
+        (1, 100, True),
+        (1000, 5, True),
+        (5, 1000, True),
+    ],
+)
+async def test_as_completed_with_concurrency(
+    parallel: int, num_tasks: int, ordered: bool, is_async: bool
+) -> None:
+    """Test that as_completed_with_concurrency starts tasks lazily.
+
+    That is, that tasks are only created as slots free up, that at most
+    parallel number of tasks run at a time, and that all results are yielded.
+
+    Args:
+        parallel: Number of tasks to run in parallel.
+        num_tasks: Number of tasks to spawn.
+        ordered: Whether results should be yielded in input order.
+        is_async: Whether to provide the factories as an async iterable.
+
+    Returns:
+        None
+    """
+    created = 0
+    finished = 0
+    running = 0
+    max_running = 0
+
+    async def intensive_task(i: int) -> int:
+        """An emulated intensive task with a varying runtime.
+
+        Args:
+            i: Task id
+
+        Returns:
+            Task id
+        """
+        nonlocal finished, running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        for _ in range(1 + i % 3):
+            await asyncio.sleep(0)
+        running -= 1
+        finished += 1
+        return i
+
+    def factories() -> Iterator[Callable[[], Awaitable[int]]]:
+        nonlocal created
+        for i in range(num_tasks):
+            created += 1
+            # Tasks are only created when a slot is free
+            assert created - finished <= parallel
+            yield partial(intensive_task, i)
+
+    async def async_factories() -> AsyncIterator[Callable[[], Awaitable[int]]]:
+        for factory in factories():
+            yield factory
+
+    source = async_factories() if is_async else factories()
+    result = [x async for x in as_completed_with_concurrency(parallel, source, ordered)]
+    assert max_running == min(parallel, num_tasks)
+    assert sorted(result) == list(range(num_tasks))
+    if ordered:
+        assert result == list(range(num_tasks))
+
+
+async def test_as_completed_with_concurrency_window() -> None:
+    """Test that ordered mode does not run ahead of the reorder window.
+
+    Returns:
+        None
+    """
+    blocker = asyncio.Event()
+    started = []
+
+    async def task(i: int) -> int:
+        """Task that blocks until released, if it is the first task.
+
+        Args:
+            i: Task id
+
+        Returns:
+            Task id
+        """
+        started.append(i)
+        if i == 0:
+            await blocker.wait()
+        return i
+
+    loop = asyncio.get_running_loop()
+    loop.call_later(0.01, blocker.set)
+
+    factories = (partial(task, i) for i in range(100))
+    iterator = as_completed_with_concurrency(2, factories, ordered=True, window=10)
+    assert await iterator.__anext__() == 0
+    # Task 0 blocked the head of the window, so only 10 tasks could be started
+    assert started[:10] == list(range(10))
+    assert [x async for x in iterator] == list(range(1, 100))
+
+
+async def test_as_completed_with_concurrency_cancels_on_error() -> None:
+    """Test that outstanding tasks are cancelled when a task fails.
+
+    Returns:
+        None
+    """
+    cancelled = []
+
+    async def slow_task() -> None:
+        """Task that never finishes on its own.
+
+        Returns:
+            None
+        """
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def failing_task() -> None:
+        """Task that fails immediately.
+
+        Raises:
+            ValueError: always.
+        """
+        raise ValueError("Oh no")
+
+    factories = [slow_task, slow_task, failing_task, slow_task]
+    with pytest.raises(ValueError, match="Oh no"):
+        async for _ in as_completed_with_concurrency(3, factories):
+            pass  # pragma: no cover
+    await asyncio.sleep(0)
+    assert cancelled == [True, True]
+
+
+@pytest.mark.parametrize("ordered", [False, True])
+async def test_as_completed_with_concurrency_retrieves_errors(ordered: bool) -> None:
+    """Test that the errors of sibling tasks are retrieved when a task fails.
+
+    Args:
+        ordered: Whether to yield results in input order.
+
+    Returns:
+        None
+    """
+    errors = []
+    loop = asyncio.get_running_loop()
+    loop.set_exception_handler(lambda loop, context: errors.append(context))
+
+    async def failing_task() -> None:
+        """Task that fails immediately.
+
+        Raises:
+            ValueError: always.
+        """
+        raise ValueError("Oh no")
+
+    factories = [failing_task, failing_task, failing_task]
+    with pytest.raises(ValueError, match="Oh no"):
+        async for _ in as_completed_with_concurrency(3, factories, ordered):
+            pass  # pragma: no cover
+    gc.collect()
+    assert errors == []
+
+
+async def test_with_concurrency_keyed() -> None:
+    """Test that keyed concurrency limits each key independently.
+
+    Returns:
+        None
+    """
+    blocker = asyncio.Event()
+    running: Dict[str, int] = defaultdict(int)
+    max_running: Dict[str, int] = defaultdict(int)
+
+    @with_concurrency(2, key=lambda host, i: host)
+    async def fetch(host: str, i: int) -> int:
+        """Emulated request against a host.
+
+        Args:
+            host: Host to request.
+            i: Request id
+
+        Returns:
+            Request id
+        """
+        running[host] += 1
+        max_running[host] = max(max_running[host], running[host])
+        await blocker.wait()
+        running[host] -= 1
+        return i
+
+    loop = asyncio.get_running_loop()
+    loop.call_later(0.01, blocker.set)
+
+    tasks = [fetch(host, i) for host in ("mo", "lora", "keycloak") for i in range(10)]
+    result = await asyncio.gather(*tasks)
+    assert len(result) == 30
+    assert max_running == {"mo": 2, "lora": 2, "keycloak": 2}
+
+
+def test_with_concurrency_per_loop() -> None:
+    """Test that semaphores are bound to, and released with, the running loop.
+
+    Returns:
+        None
+    """
+
+    @with_concurrency(1)
+    async def task(i: int) -> int:
+        """Task which yields to the event-loop, contending for the semaphore.
+
+        Args:
+            i: Task id
+
+        Returns:
+            Task id
+        """
+        await asyncio.sleep(0)
+        return i
+
+    async def run() -> List[int]:
+        return list(await asyncio.gather(*map(task, range(5))))
+
+    loops = []
+    for _ in range(3):
+        loop = asyncio.new_event_loop()
+        assert loop.run_until_complete(run()) == list(range(5))
+        loop.close()
+        loops.append(weakref.ref(loop))
+        del loop
+
+    gc.collect()
+    assert all(loop() is None for loop in loops)
+
+
+class FakeClock:
+    """Deterministic clock, only advanced by sleeping.
+
+    Sleepers are woken in order of their wake-up time, each advancing the clock
+    to its wake-up time, once all earlier sleepers have been woken.
+    """
+
+    def __init__(self) -> None:
+        self.now = 0.0
+        self.sleepers: List[float] = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds: float) -> None:
+        wakeup = self.now + seconds
+        heapq.heappush(self.sleepers, wakeup)
+        while self.sleepers[0] < wakeup:
+            await asyncio.sleep(0)
+        heapq.heappop(self.sleepers)
+        self.now = max(self.now, wakeup)
+
+
+@pytest.mark.parametrize("rate, burst", [(0, 1), (-1, 1), (1, 0)])
+def test_rate_limiter_invalid_input(rate: float, burst: int) -> None:
+    """Test that invalid inputs are rejected.
+
+    Args:
+        rate: Number of tokens added per second.
+        burst: Maximum number of tokens in the bucket.
+
+    Returns:
+        None
+    """
+    with pytest.raises(ValueError):
+        RateLimiter(rate, burst)
+
+
+@pytest.mark.parametrize(
+    "rate, burst, num_tasks",
+    [
+        (1, 1, 10),
+        (10, 5, 100),
+        (0.5, 3, 10),
+    ],
+)
+async def test_with_rate_limit(rate: float, burst: int, num_tasks: int) -> None:
+    """Test that with_rate_limit allows a burst, and then calls at the rate.
+
+    Args:
+        rate: Number of calls allowed per second.
+        burst: Number of calls allowed in a burst.
+        num_tasks: Number of tasks to spawn.
+
+    Returns:
+        None
+    """
+    clock = FakeClock()
+    started: List[float] = []
+
+    @with_rate_limit(rate, burst, clock=clock, sleep=clock.sleep)
+    async def task(i: int) -> int:
+        """Task recording when it was started.
+
+        Args:
+            i: Task id
+
+        Returns:
+            Task id
+        """
+        started.append(clock())
+        return i
+
+    tasks = list(map(task, range(num_tasks)))
+    result = await gather_with_concurrency(num_tasks, *tasks)
+    assert result == list(range(num_tasks))
+    assert started[:burst] == [0.0] * burst
+    for i, start in enumerate(started[burst:], start=1):
+        assert start == pytest.approx(i / rate)
+
+
+async def test_rate_limiter_refills() -> None:
+    """Test that tokens are refilled over time, up to the burst size.
+
+    Returns:
+        None
+    """
+    clock = FakeClock()
+    limiter = RateLimiter(2, burst=4, clock=clock, sleep=clock.sleep)
+    assert limiter.tokens == 4
+    for _ in range(4):
+        async with limiter:
+            pass
+    assert limiter.tokens == 0
+    clock.now += 1
+    assert limiter.tokens == 2
+    clock.now += 100
+    assert limiter.tokens == 4
+
+
+def test_rate_limiter_threads() -> None:
+    """Test that event-loops on different threads do not overdraw the bucket.
+
+    Returns:
+        None
+    """
+    limiter = RateLimiter(1e-9, burst=1000, clock=lambda: 0.0, sleep=asyncio.sleep)
+    barrier = threading.Barrier(8)
+    lock = threading.Lock()
+    acquired = 0
+
+    async def acquire_all() -> None:
+        nonlocal acquired
+        for _ in range(500):
+            await limiter.acquire()
+            with lock:
+                acquired += 1
+
+    def run(_: int) -> None:
+        barrier.wait()
+        try:
+            asyncio.run(asyncio.wait_for(acquire_all(), 0.5))
+        except asyncio.TimeoutError:
+            pass  # Waiting for tokens, which are never added
+
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with ThreadPoolExecutor(8) as executor:
+            list(executor.map(run, range(8)))
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert acquired == 1000
+    # Each cancelled waiter gave back its reservation
+    assert limiter.tokens == 0
+
+
+async def test_rate_limiter_cancellation() -> None:
+    """Test that cancelled waiters give back their reserved token.
+
+    Returns:
+        None
+    """
+    limiter = RateLimiter(1, burst=1, sleep=lambda _: asyncio.Event().wait())
+    await limiter.acquire()
+    waiter = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0)
+    assert limiter.tokens < 0
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    assert 0 <= limiter.tokens < 1
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"minimum": 0},
+        {"initial": 5, "maximum": 4},
+        {"initial": 1, "minimum": 2},
+        {"increase": 0},
+        {"decrease": 0},
+        {"decrease": 1},
+    ],
+)
+def test_adaptive_concurrency_invalid_input(kwargs: Dict[str, Any]) -> None:
+    """Test that invalid inputs are rejected.
+
+    Args:
+        kwargs: Arguments for AdaptiveConcurrency.
+
+    Returns:
+        None
+    """
+    with pytest.raises(ValueError):
+        AdaptiveConcurrency(**kwargs)
+
+
+async def test_adaptive_concurrency_increase() -> None:
+    """Test that the limit grows additively on success, up to the maximum.
+
+    Returns:
+        None
+    """
+    limiter = AdaptiveConcurrency(initial=1, maximum=20)
+
+    @limiter
+    async def task(i: int) -> int:
+        """Dummy noop task.
+
+        Args:
+            i: Task id
+
+        Returns:
+            Task id
+        """
+        return i
+
+    limits = []
+    for i in range(100):
+        assert await task(i) == i
+        limits.append(limiter.limit)
+    assert limits == sorted(limits)
+    # Increasing by one per limit successful calls, grows as sqrt(2 * calls)
+    assert 12 <= limiter.limit <= 15
+    for i in range(1000):
+        await task(i)
+    assert limiter.limit == 20
+    assert limiter.in_flight == 0
+
+
+async def test_adaptive_concurrency_decrease() -> None:
+    """Test that the limit is cut once per burst of failures.
+
+    Returns:
+        None
+    """
+    limiter = AdaptiveConcurrency(initial=16, minimum=3)
+
+    @limiter
+    async def failing_task() -> None:
+        """Task that fails after yielding to the event-loop.
+
+        Raises:
+            ValueError: always.
+        """
+        await asyncio.sleep(0)
+        raise ValueError("Oh no")
+
+    # All failures are from calls started before the first decrease
+    tasks = [failing_task() for _ in range(10)]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    assert all(isinstance(result, ValueError) for result in results)
+    assert limiter.limit == 8
+
+    for expected in (4, 3, 3):
+        with pytest.raises(ValueError):
+            await failing_task()
+        assert limiter.limit == expected
+    assert limiter.in_flight == 0
+
+
+async def test_adaptive_concurrency_latency() -> None:
+    """Test that slow calls decrease the limit, like failures.
+
+    Returns:
+        None
+    """
+    clock = FakeClock()
+    limiter = AdaptiveConcurrency(initial=8, latency_threshold=1.0, clock=clock)
+
+    @limiter
+    async def task(duration: float) -> None:
+        """Task taking the given duration.
+
+        Args:
+            duration: Time to sleep.
+
+        Returns:
+            None
+        """
+        await clock.sleep(duration)
+
+    await task(0.5)
+    assert limiter.limit == 8
+    await task(1.5)
+    assert limiter.limit == 4
+
+
+async def test_adaptive_concurrency_gather() -> None:
+    """Test that gather_with_concurrency respects the adaptive limit.
+
+    Returns:
+        None
+    """
+    limiter = AdaptiveConcurrency(initial=2, maximum=10)
+    running = 0
+    max_running = 0
+    violations = 0
+
+    async def task(i: int) -> int:
+        """Task recording concurrency.
+
+        Args:
+            i: Task id
+
+        Returns:
+            Task id
+        """
+        nonlocal running, max_running, violations
+        running += 1
+        max_running = max(max_running, running)
+        if running > limiter.limit:
+            violations += 1  # pragma: no cover
+        await asyncio.sleep(0)
+        running -= 1
+        return i
+
+    tasks = list(map(task, range(200)))
+    assert await gather_with_concurrency(limiter, *tasks) == list(range(200))
+    assert violations == 0
+    assert max_running == 10
+    assert limiter.in_flight == 0
+
+
+async def test_adaptive_concurrency_cancellation() -> None:
+    """Test that cancelled waiters do not leak slots.
+
+    Returns:
+        None
+    """
+    limiter = AdaptiveConcurrency(initial=1)
+    blocker = asyncio.Event()
+
+    @limiter
+    async def task() -> None:
+        """Task that blocks until released.
+
+        Returns:
+            None
+        """
+        await blocker.wait()
+
+    first = asyncio.ensure_future(task())
+    second = asyncio.ensure_future(task())
+    await asyncio.sleep(0)
+    assert limiter.in_flight == 1
+    second.cancel()
+    blocker.set()
+    await first
+    with pytest.raises(asyncio.CancelledError):
+        await second
+    assert limiter.in_flight == 0
+
+
+@pytest.mark.parametrize("max_batch_size, delay", [(0, 0.0), (1, -1.0)])
+def test_batch_loader_invalid_input(max_batch_size: int, delay: float) -> None:
+    """Test that invalid inputs are rejected.
+
+    Args:
+        max_batch_size: The maximum number of keys per batch.
+        delay: Seconds to wait for more keys.
+
+    Returns:
+        None
+    """
+
+    async def lookup(keys: List[int]) -> List[int]:
+        return keys  # pragma: no cover
+
+    with pytest.raises(ValueError):
+        BatchLoader(lookup, max_batch_size, delay)
+
+
+@pytest.mark.parametrize("delay", [0.0, 0.001])
+@pytest.mark.parametrize(
+    "max_batch_size, num_keys, expected_batches",
+    [
+        (100, 10, [10]),
+        (4, 10, [4, 4, 2]),
+        (1, 3, [1, 1, 1]),
+    ],
+)
+async def test_with_batching(
+    max_batch_size: int, num_keys: int, expected_batches: List[int], delay: float
+) -> None:
+    """Test that concurrent loads are collected into batches.
+
+    Args:
+        max_batch_size: The maximum number of keys per batch.
+        num_keys: Number of distinct keys to load.
+        expected_batches: Expected sizes of the batches.
+        delay: Seconds to wait for more keys.
+
+    Returns:
+        None
+    """
+    batches: List[List[int]] = []
+
+    @with_batching(max_batch_size, delay)
+    async def double(keys: List[int]) -> List[int]:
+        """Batch function doubling each key.
+
+        Args:
+            keys: Keys to double.
+
+        Returns:
+            Doubled keys.
+        """
+        batches.append(keys)
+        return [key * 2 for key in keys]
+
+    # Every key is loaded twice, but only looked up once
+    keys = list(range(num_keys)) * 2
+    result = await asyncio.gather(*map(double, keys))
+    assert result == [key * 2 for key in keys]
+    assert list(map(len, batches)) == expected_batches
+
+    # Cached results do not trigger new batches
+    assert await double.load_many(range(num_keys)) == result[:num_keys]
+    assert len(batches) == len(expected_batches)
+
+    # Scoped loaders start with an empty cache
+    assert await double.scoped()(0) == 0
+    assert len(batches) == len(expected_batches) + 1
+
+
+async def test_with_batching_mapping_and_errors() -> None:
+    """Test that mapping results and failures are fanned out to callers.
+
+    Returns:
+        None
+    """
+    calls = 0
+
+    @with_batching()
+    async def lookup(keys: List[str]) -> Dict[str, str]:
+        """Batch function failing on the first call, and skipping unknown keys.
+
+        Args:
+            keys: Keys to look up.
+
+        Raises:
+            ValueError: on the first call.
+
+        Returns:
+            Upper-cased keys, except for "unknown".
+        """
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            raise ValueError("Oh no")
+        return {key: key.upper() for key in keys if key != "unknown"}
+
+    results = await asyncio.gather(lookup("a"), lookup("b"), return_exceptions=True)
+    assert all(isinstance(result, ValueError) for result in results)
+
+    # Failures are not cached
+    results = await asyncio.gather(
+        lookup("a"), lookup("unknown"), return_exceptions=True
+    )
+    assert results[0] == "A"
+    assert isinstance(results[1], KeyError)
+    assert calls == 2
+
+
+async def test_with_batching_wrong_length() -> None:
+    """Test that batch functions returning the wrong number of values fail.
+
+    Returns:
+        None
+    """
+
+    @with_batching(cache=False)
+    async def lookup(keys: List[int]) -> List[int]:
+        """Batch function returning too few values.
+
+        Args:
+            keys: Keys to look up.
+
+        Returns:
+            Nothing.
+        """
+        return []
+
+    with pytest.raises(ValueError, match="returned 0 values for 1 keys"):
+        await lookup(1)
+
+
+def test_with_batching_new_event_loop() -> None:
+    """Test that loaders recover from event-loops ending with pending batches.
+
+    Returns:
+        None
+    """
+    batches = []
+
+    @with_batching(delay=0.1)
+    async def lookup(keys: List[int]) -> List[int]:
+        """Batch function doubling its keys.
+
+        Args:
+            keys: Keys to look up.
+
+        Returns:
+            The doubled keys.
+        """
+        batches.append(keys)
+        return [key * 2 for key in keys]
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(asyncio.wait_for(lookup(1), 0.01))
+    assert asyncio.run(asyncio.wait_for(lookup(1), 1)) == 2
+    assert asyncio.run(asyncio.wait_for(lookup(2), 1)) == 4
+    assert batches == [[1], [2]]
+
+
+def test_with_batching_concurrent_event_loops() -> None:
+    """Test that loaders can be used from several event-loops at once.
+
+    Returns:
+        None
+    """
+    batches = []
+
+    @with_batching(delay=0.05)
+    async def lookup(keys: List[int]) -> List[int]:
+        """Batch function doubling its keys.
+
+        Args:
+            keys: Keys to look up.
+
+        Returns:
+            The doubled keys.
+        """
+        batches.append(sorted(keys))
+        return [key * 2 for key in keys]
+
+    barrier = threading.Barrier(4)
+
+    def run(offset: int) -> List[int]:
+        """Look up keys on an event-loop of its own.
+
+        Args:
+            offset: Offset of the keys to look up.
+
+        Returns:
+            The looked up values.
+        """
+        barrier.wait()
+        keys = range(offset, offset + 3)
+        return asyncio.run(asyncio.wait_for(lookup.load_many(keys), 1))
+
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(run, [0, 10, 20, 30]))
+    assert results == [[0, 2, 4], [20, 22, 24], [40, 42, 44], [60, 62, 64]]
+    assert sorted(batches) == [[0, 1, 2], [10, 11, 12], [20, 21, 22], [30, 31, 32]]
+
+
+@pytest.mark.parametrize("kwargs", [{"attempts": 0}, {"jitter": -0.1}, {"jitter": 2}])
+def test_retry_policy_invalid_input(kwargs: Dict[str, Any]) -> None:
+    """Test that invalid inputs are rejected.
+
+    Args:
+        kwargs: Arguments for RetryPolicy.
+
+    Returns:
+        None
+    """
+    with pytest.raises(ValueError):
+        RetryPolicy(**kwargs)
+
+
+def test_retry_policy_delay() -> None:
+    """Test that delays grow exponentially, up to the maximum, with jitter.
+
+    Returns:
+        None
+    """
+    policy = RetryPolicy(base_delay=1, max_delay=10, multiplier=3, jitter=0.5)
+    delays = [policy.delay(retry, random=lambda: 0.0) for retry in range(5)]
+    assert delays == [1, 3, 9, 10, 10]
+    delays = [policy.delay(retry, random=lambda: 1.0) for retry in range(5)]
+    assert delays == [0.5, 1.5, 4.5, 5, 5]
+
+
+async def test_with_retry() -> None:
+    """Test that failing calls are retried according to per-exception policies.
+
+    Returns:
+        None
+    """
+    clock = FakeClock()
+    failures = [ValueError(), KeyError(), ValueError(), ValueError(), KeyError()]
+
+    @with_retry(
+        {
+            ValueError: RetryPolicy(attempts=4, base_delay=1, jitter=0),
+            KeyError: RetryPolicy(attempts=3, base_delay=10, max_delay=60, jitter=0),
+        },
+        clock=clock,
+        sleep=clock.sleep,
+    )
+    async def task() -> str:
+        """Task failing with the given failures, before succeeding.
+
+        Raises:
+            Exception: the next failure, if any.
+
+        Returns:
+            A greeting.
+        """
+        if failures:
+            raise failures.pop(0)
+        return "hello"
+
+    assert await task() == "hello"
+    # ValueError retries wait 1, 2 and 4 seconds, KeyError retries 10 and 20
+    assert clock.now == 1 + 10 + 2 + 4 + 20
+
+    # Attempts are exhausted
+    failures.extend([ValueError()] * 4)
+    with pytest.raises(ValueError):
+        await task()
+    assert failures == []
+
+    # Unmatched exceptions are not retried
+    failures.extend([TypeError(), TypeError()])
+    with pytest.raises(TypeError):
+        await task()
+    assert len(failures) == 1
+
+
+async def test_with_retry_equal_policies() -> None:
+    """Test that exception types with equal policies have separate attempts.
+
+    Returns:
+        None
+    """
+    clock = FakeClock()
+    failures = [ValueError(), ValueError(), KeyError(), KeyError()]
+
+    @with_retry(
+        {ValueError: RetryPolicy(jitter=0), KeyError: RetryPolicy(jitter=0)},
+        clock=clock,
+        sleep=clock.sleep,
+    )
+    async def task() -> str:
+        """Task failing with the given failures, before succeeding.
+
+        Raises:
+            Exception: the next failure, if any.
+
+        Returns:
+            A greeting.
+        """
+        if failures:
+            raise failures.pop(0)
+        return "hello"
+
+    assert await task() == "hello"
+
+
+async def test_with_retry_budget() -> None:
+    """Test that no retries are started after the time budget is spent.
+
+    Returns:
+        None
+    """
+    clock = FakeClock()
+    attempts = 0
+
+    @with_retry(
+        RetryPolicy(attempts=100, base_delay=1, multiplier=1, jitter=0),
+        budget=5.5,
+        clock=clock,
+        sleep=clock.sleep,
+    )
+    async def task() -> None:
+        """Task that always fails.
+
+        Raises:
+            ValueError: always.
+        """
+        nonlocal attempts
+        attempts += 1
+        raise ValueError("Oh no")
+
+    with pytest.raises(ValueError):
+        await task()
+    assert attempts == 6
+    assert clock.now == 5
+
+
+@pytest.mark.parametrize("limiter", ["with_concurrency", "adaptive", "gather"])
+async def test_with_retry_releases_slot(limiter: str) -> None:
+    """Test that the concurrency slot is released while backing off.
+
+    The failing task backs off until the other task has run, which would
+    deadlock if the slot was held during the back off.
+
+    Args:
+        limiter: How concurrency is limited.
+
+    Returns:
+        None
+    """
+    other_done = asyncio.Event()
+    attempts = 0
+
+    async def backoff(_: float) -> None:
+        await other_done.wait()
+
+    @with_retry(RetryPolicy(attempts=2), sleep=backoff)
+    async def failing_task() -> str:
+        """Task which fails on the first attempt.
+
+        Raises:
+            ValueError: on the first attempt.
+
+        Returns:
+            A greeting.
+        """
+        nonlocal attempts
+        attempts += 1
+        if attempts == 1:
+            raise ValueError("Oh no")
+        return "hello"
+
+    async def other_task() -> str:
+        """Task which unblocks the failing task.
+
+        Returns:
+            A greeting.
+        """
+        other_done.set()
+        return "world"
+
+    if limiter == "gather":
+        gathered = gather_with_concurrency(1, failing_task(), other_task())
+    else:
+        decorator = (
+            with_concurrency(1)
+            if limiter == "with_concurrency"
+            else AdaptiveConcurrency(initial=1, maximum=1)
+        )
+        gathered = gather_with_concurrency(
+            2, decorator(failing_task)(), decorator(other_task)()
+        )
+    result = await asyncio.wait_for(gathered, timeout=1)
+    assert result == ["hello", "world"]
+    assert attempts == 2
+
+
+async def test_released_slot_without_slot() -> None:
+    """Test that released_slot does nothing if no slot is held.
+
+    Returns:
+        None
+    """
+    async with released_slot():
+        pass
+
+
+@pytest.mark.parametrize("adaptive", [False, True])
+async def test_released_slot_cancelled_while_reacquiring(adaptive: bool) -> None:
+    """Test that a slot is not released twice, if cancelled while re-acquiring.
+
+    Args:
+        adaptive: Whether to limit using AdaptiveConcurrency.
+
+    Returns:
+        None
+    """
+    limiter = AdaptiveConcurrency(initial=1, maximum=1)
+    decorator = limiter if adaptive else with_concurrency(1)
+    released = asyncio.Event()
+    backed_off = asyncio.Event()
+    holding = asyncio.Event()
+    release = asyncio.Event()
+    running = 0
+    peak = 0
+
+    @decorator
+    async def backing_off() -> None:
+        async with released_slot():
+            released.set()
+            await backed_off.wait()
+
+    @decorator
+    async def holder() -> None:
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        holding.set()
+        await release.wait()
+        running -= 1
+
+    @decorator
+    async def task() -> None:
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    backing_off_task = asyncio.ensure_future(backing_off())
+    await released.wait()
+    holder_task = asyncio.ensure_future(holder())
+    await holding.wait()
+    backed_off.set()
+    await asyncio.sleep(0.01)  # Now waiting to re-acquire the slot
+    assert not backing_off_task.done()
+    backing_off_task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await backing_off_task
+
+    tasks = asyncio.gather(*(task() for _ in range(5)))
+    await asyncio.sleep(0.01)
+    release.set()
+    await holder_task
+    await tasks
+    assert peak == 1
+    if adaptive:
+        assert limiter.in_flight == 0
+
+
+async def test_released_slot_in_child_task() -> None:
+    """Test that tasks started by the task holding a slot do not release it.
+
+    Returns:
+        None
+    """
+    running = 0
+    peak = 0
+
+    async def child() -> None:
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        async with released_slot():
+            await asyncio.sleep(0.01)
+        running -= 1
+
+    @with_concurrency(1)
+    async def parent() -> None:
+        await asyncio.gather(*(child() for _ in range(4)))
+
+    await asyncio.gather(*(parent() for _ in range(3)))
+    assert peak == 4
+
+
+async def test_with_concurrency_metrics() -> None:
+    """Test that with_concurrency records waiting and running calls.
+
+    Returns:
+        None
+    """
+    registry = CollectorRegistry()
+    metrics = ConcurrencyMetrics("test", registry=registry)
+    blocker = asyncio.Event()
+
+    def sample(name: str) -> Optional[float]:
+        return registry.get_sample_value(f"test_{name}")
+
+    @with_concurrency(2, metrics=metrics)
+    async def task(i: int) -> int:
+        """Task that blocks until released, and fails for odd ids.
+
+        Args:
+            i: Task id
+
+        Raises:
+            ValueError: for odd task ids.
+
+        Returns:
+            Task id
+        """
+        await blocker.wait()
+        if i % 2:
+            raise ValueError("Oh no")
+        return i
+
+    tasks = asyncio.gather(*map(task, range(5)), return_exceptions=True)
+    await asyncio.sleep(0)
+    assert sample("in_flight") == 2
+    assert sample("waiting") == 3
+
+    blocker.set()
+    await tasks
+    assert sample("in_flight") == 0
+    assert sample("waiting") == 0
+    assert sample("wait_seconds_count") == 5
+    assert sample("run_seconds_count") == 5
+    assert sample("errors_total") == 2
+
+
+async def test_gather_in_executor_invalid_input() -> None:
+    """Test that invalid inputs are rejected.
+
+    Returns:
+        None
+    """
+    with pytest.raises(ValueError):
+        await gather_in_executor(0)
+    with pytest.raises(ValueError):
+        await gather_in_executor(1, chunksize=0)
+
+
+@pytest.mark.parametrize(
+    "parallel,num_tasks,chunksize",
+    [
+        (1, 0, 1),
+        (1, 20, 1),
+        (4, 100, 1),
+        (4, 100, 7),
+        (100, 10, 3),
+    ],
+)
+async def test_gather_in_executor(
+    parallel: int, num_tasks: int, chunksize: int
+) -> None:
+    """Test that gather_in_executor limits the number of callables running.
+
+    Args:
+        parallel: Number of chunks to run in parallel.
+        num_tasks: Number of callables to run.
+        chunksize: Number of callables per chunk.
+
+    Returns:
+        None
+    """
+    lock = threading.Lock()
+    running = 0
+    max_running = 0
+
+    def blocking_task(i: int) -> int:
+        """An emulated blocking task.
+
+        Args:
+            i: Task id
+
+        Returns:
+            Task id
+        """
+        nonlocal running, max_running
+        with lock:
+            running += 1
+            max_running = max(max_running, running)
+        time.sleep(0.001)
+        with lock:
+            running -= 1
+        return i
+
+    funcs = [partial(blocking_task, i) for i in range(num_tasks)]
+    result = await gather_in_executor(parallel, *funcs, chunksize=chunksize)
+    assert result == list(range(num_tasks))
+    assert max_running <= parallel
+
+
+async def test_gather_in_executor_processes() -> None:
+    """Test that gather_in_executor can run chunks on the shared process pool.
+
+    Returns:
+        None
+    """
+    funcs = [partial(pow, i, 2) for i in range(100)]
+    result = await gather_in_executor(2, *funcs, processes=True, chunksize=10)
+    assert result == [i**2 for i in range(100)]
+    assert isinstance(shared_executor(processes=True), ProcessPoolExecutor)
+    assert shared_executor(processes=True) is shared_executor(processes=True)
+
+
+async def test_gather_in_executor_reconfigured() -> None:
+    """Test that reconfiguring the shared executor does not break running gathers.
+
+    Returns:
+        None
+    """
+    configured = threading.Event()
+
+    def configure() -> int:
+        """Reconfigure the shared executor from within a running gather.
+
+        Returns:
+            Zero
+        """
+        configure_shared_executor(2)
+        configured.set()
+        return 0
+
+    def wait(i: int) -> int:
+        """Wait for the shared executor to be reconfigured.
+
+        Args:
+            i: Task id
+
+        Returns:
+            Task id
+        """
+        assert configured.wait(timeout=5)
+        return i
+
+    funcs = [configure, *(partial(wait, i) for i in range(1, 10))]
+    try:
+        assert await gather_in_executor(1, *funcs) == list(range(10))
+    finally:
+        configure_shared_executor(None)
+
+
+async def test_gather_with_concurrency_fail_fast() -> None:
+    """Test that fail_fast cancels outstanding tasks on the first error.
+
+    Returns:
+        None
+    """
+    started = 0
+    cancelled = 0
+
+    async def task(i: int) -> int:
+        """Task that fails for the first id, and blocks for the others.
+
+        Args:
+            i: Task id
+
+        Raises:
+            ValueError: for the first task.
+
+        Returns:
+            Task id
+        """
+        nonlocal started, cancelled
+        started += 1
+        if i == 0:
+            raise ValueError("Oh no")
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            cancelled += 1
+            raise
+        return i  # pragma: no cover
+
+    tasks = list(map(task, range(100)))
+    with pytest.raises(ValueError, match="Oh no"):
+        await gather_with_concurrency(5, *tasks, fail_fast=True)
+    await asyncio.sleep(0)
+    # Only the tasks which got a slot were started, and all of them were cancelled
+    assert started <= 6
+    assert cancelled == started - 1
+
+
+async def test_gather_with_concurrency_timeouts() -> None:
+    """Test per-task and overall timeouts, and returning exceptions.
+
+    Returns:
+        None
+    """
+
+    async def task(seconds: float) -> float:
+        """Task sleeping for the given duration.
+
+        Args:
+            seconds: Duration to sleep.
+
+        Returns:
+            The duration slept.
+        """
+        await asyncio.sleep(seconds)
+        return seconds
+
+    tasks = [task(0), task(10), task(0)]
+    result = await gather_with_concurrency(
+        1, *tasks, task_timeout=0.01, return_exceptions=True
+    )
+    assert result[0] == 0
+    assert isinstance(result[1], asyncio.TimeoutError)
+    assert result[2] == 0
+
+    tasks = [task(0), task(10), task(0)]
+    with pytest.raises(asyncio.TimeoutError):
+        await gather_with_concurrency(1, *tasks, task_timeout=0.01)
+
+    tasks = [task(0), task(0.01), task(10), task(0)]
+    with pytest.raises(asyncio.TimeoutError):
+        await gather_with_concurrency(2, *tasks, timeout=0.1)
+
+
+def test_pipeline_invalid_input() -> None:
+    """Test that invalid inputs are rejected.
+
+    Returns:
+        None
+    """
+
+    async def stage(item: int) -> int:
+        return item  # pragma: no cover
+
+    with pytest.raises(ValueError):
+        Pipeline()
+    with pytest.raises(ValueError):
+        PipelineStage(stage, parallel=0)
+    with pytest.raises(ValueError):
+        PipelineStage(stage, queue_size=0)
+
+
+@pytest.mark.parametrize("is_async", [False, True])
+async def test_pipeline(is_async: bool) -> None:
+    """Test that items flow through all stages, with bounded memory.
+
+    Args:
+        is_async: Whether to provide the source as an async iterable.
+
+    Returns:
+        None
+    """
+    produced = 0
+    written: List[int] = []
+    running: Dict[str, int] = defaultdict(int)
+    max_running: Dict[str, int] = defaultdict(int)
+
+    async def track(name: str) -> None:
+        """Record concurrency for a stage, while yielding to the event-loop.
+
+        Args:
+            name: Name of the stage.
+
+        Returns:
+            None
+        """
+        running[name] += 1
+        max_running[name] = max(max_running[name], running[name])
+        await asyncio.sleep(0)
+        running[name] -= 1
+
+    def source() -> Iterator[int]:
+        nonlocal produced
+        for i in range(200):
+            produced += 1
+            # Read + transform + write workers, plus their queues
+            assert produced - len(written) <= 4 + 2 + 1 + 8 + 2 + 1 + 1
+            yield i
+
+    async def async_source() -> AsyncIterator[int]:
+        for i in source():
+            yield i
+
+    async def read(i: int) -> int:
+        await track("read")
+        return i
+
+    async def transform(i: int) -> int:
+        await track("transform")
+        return i * 2
+
+    async def write(i: int) -> None:
+        await track("write")
+        await asyncio.sleep(0)
+        written.append(i)
+
+    pipeline = Pipeline(
+        PipelineStage(read, parallel=4, queue_size=8),
+        PipelineStage(transform, parallel=2),
+        PipelineStage(write),
+    )
+    statistics = await pipeline.run(async_source() if is_async else source())
+    assert sorted(written) == [i * 2 for i in range(200)]
+    assert max_running == {"read": 4, "transform": 2, "write": 1}
+    assert [stage.name for stage in statistics] == ["read", "transform", "write"]
+    assert [stage.processed for stage in statistics] == [200, 200, 200]
+    assert all(stage.finished is not None for stage in statistics)
+
+
+async def test_pipeline_statistics() -> None:
+    """Test that per-stage throughput is reported.
+
+    Returns:
+        None
+    """
+    clock = FakeClock()
+
+    async def slow(i: int) -> int:
+        await clock.sleep(1)
+        return i
+
+    pipeline = Pipeline(PipelineStage(slow, parallel=2, name="double"), clock=clock)
+    (statistics,) = await pipeline.run(range(10))
+    assert statistics.name == "double"
+    assert statistics.processed == 10
+    assert statistics.busy_seconds == 10
+    assert 5 <= statistics.elapsed <= 10
+    assert statistics.throughput == 10 / statistics.elapsed
+    assert pipeline.statistics == [statistics]
+
+
+async def test_pipeline_error() -> None:
+    """Test that a failing stage cancels the pipeline, before raising.
+
+    Returns:
+        None
+    """
+    cancelled = 0
+
+    async def fail(i: int) -> int:
+        if i == 5:
+            raise ValueError("Oh no")
+        return i
+
+    async def block(i: int) -> None:
+        nonlocal cancelled
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            cancelled += 1
+            raise
+
+    pipeline = Pipeline(PipelineStage(fail), PipelineStage(block, parallel=3))
+    with pytest.raises(ValueError, match="Oh no"):
+        await pipeline.run(range(100))
+    assert cancelled == 3
@@ -1,14 +1,24 @@
 # SPDX-FileCopyrightText: 2021 Magenta ApS <https://magenta.dk>
 # SPDX-License-Identifier: MPL-2.0
+import copy
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from unittest import skipUnless
 from unittest import TestCase
 from uuid import UUID
 
 from hypothesis import given
+from hypothesis.strategies import lists
 from hypothesis.strategies import text
 
 from ra_utils.generate_uuid import _generate_uuid
+from ra_utils.generate_uuid import _has_numpy
 from ra_utils.generate_uuid import generate_uuid
+from ra_utils.generate_uuid import generate_uuid_array
+from ra_utils.generate_uuid import generate_uuid_bytes
+from ra_utils.generate_uuid import generate_uuids
 from ra_utils.generate_uuid import uuid_generator
+from ra_utils.generate_uuid import UuidGenerator
 
 
 class test_generate_uuid(TestCase):
@@ -47,3 +57,94 @@ class test_generate_uuid(TestCase):
         uuid4 = generate_uuid("kommune", "key4")
         assert uuid3 == UUID("eda99313-033b-50ee-6485-0b0ba30a5f62")
         assert uuid4 == UUID("3e4fbcd4-83d4-976c-3838-f077e9b39129")
+
+    @given(text(), text())
+    def test_uuid_generator_class(self, base, value):
+        gen = UuidGenerator(base, maxsize=None)
+        assert gen(value) == generate_uuid(base, value)
+        assert gen.base == base
+
+    def test_uuid_generator_cache(self):
+        gen = uuid_generator("kommune", maxsize=2)
+        assert gen("key1") == UUID("fd995619-6f00-cf70-2569-b3f578d9c0da")
+        gen("key1")
+        gen("key2")
+        info = gen.cache_info()
+        assert (info.hits, info.misses, info.maxsize, info.currsize) == (1, 2, 2, 2)
+
+        # The least recently used UUID is evicted
+        gen("key3")
+        gen("key1")
+        assert gen.cache_info().misses == 4
+        assert gen.cache_info().currsize == 2
+
+        gen.cache_clear()
+        assert gen.cache_info().currsize == 0
+        assert gen("key2") == UUID("673e80c5-ae64-632e-4a50-fb2f082f8989")
+
+    def test_uuid_generator_pickle_and_copy(self):
+        gen = uuid_generator("kommune", maxsize=2)
+        gen("key1")
+        for clone in (pickle.loads(pickle.dumps(gen)), copy.deepcopy(gen)):
+            assert (clone.base, clone.maxsize) == ("kommune", 2)
+            assert clone.cache_info().currsize == 0
+            assert clone("key1") == UUID("fd995619-6f00-cf70-2569-b3f578d9c0da")
+
+    @given(text(), lists(text()))
+    def test_generate_uuids(self, base, values):
+        expected = [generate_uuid(base, value) for value in values]
+        assert list(generate_uuids(base, values)) == expected
+        out = [None] * (len(values) + 1)
+        assert generate_uuids(base, iter(values), out) is out
+        assert out == expected + [None]
+
+    def test_generate_uuids_executor(self):
+        values = [f"key{i}" for i in range(1000)]
+        expected = [generate_uuid("kommune", value) for value in values]
+        with ThreadPoolExecutor(4) as executor:
+            uuids = generate_uuids("kommune", values, executor=executor, chunksize=7)
+            assert list(uuids) == expected
+        uuids = generate_uuids("kommune", values, processes=True, chunksize=300)
+        assert list(uuids) == expected
+        assert expected[0] == generate_uuid("kommune", "key0")
+
+        with self.assertRaises(ValueError):
+            generate_uuids("kommune", values, chunksize=0)
+
+    @given(text(), lists(text()))
+    def test_generate_uuid_bytes(self, base, values):
+        expected = b"".join(generate_uuid(base, value).bytes for value in values)
+        data = generate_uuid_bytes(base, values, chunksize=3)
+        assert isinstance(data, bytearray)
+        assert data == expected
+
+        out = memoryview(bytearray(len(expected) + 16))
+        assert generate_uuid_bytes(base, iter(values), out) is out
+        assert out[: len(expected)] == expected
+
+    def test_generate_uuid_bytes_out(self):
+        values = ["key1", "key2"]
+        with ThreadPoolExecutor(2) as executor:
+            data = generate_uuid_bytes("kommune", values, executor=executor)
+        assert UUID(bytes=bytes(data[:16])) == UUID(
+            "fd995619-6f00-cf70-2569-b3f578d9c0da"
+        )
+        with self.assertRaises(ValueError):
+            generate_uuid_bytes("kommune", values, bytearray(31))
+
+    @skipUnless(_has_numpy, "numpy not installed")
+    def test_generate_uuid_array(self):  # pragma: no cover
+        # The UUID of "key911" ends with a NUL byte
+        values = ["key1", "key2", "key911"]
+        expected = [generate_uuid("kommune", value).bytes for value in values]
+        assert expected[2][-1:] == b"\x00"
+        array = generate_uuid_array("kommune", values)
+        assert array.dtype == "V16"
+        assert [element.tobytes() for element in array] == expected
+        assert UUID(bytes=array[2].tobytes()) == generate_uuid("kommune", "key911")
+        array = generate_uuid_array("kommune", values, dtype="uint8")
+        assert array.shape == (3, 16)
+        assert array.tobytes() == b"".join(expected)
+        for dtype in ("S16", "U36"):
+            with self.assertRaises(ValueError):
+                generate_uuid_array("kommune", values, dtype=dtype)
@@ -1,8 +1,21 @@
 # SPDX-FileCopyrightText: 2021 Magenta ApS <https://magenta.dk>
 # SPDX-License-Identifier: MPL-2.0
+import asyncio
+import copy
+import gc
+import json
+import pickle
+import stat
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
 from logging import getLogger
+from threading import Barrier
+from threading import Lock
+from threading import Thread
+from threading import Timer
 
 import pytest
 import requests
@@ -30,9 +43,6 @@ class MockFetchKeycloakToken:
     def __call__(self, *args, **kwargs):
         return self.expires, "dummy token"
 
-    def cache_clear(self):
-        pass
-
 
 class MockResponse:
     def __init__(self, response_dict, raise_msg="") -> None:
@@ -47,6 +57,62 @@ class MockResponse:
             raise requests.RequestException(self.raise_msg)
 
 
+class KeycloakStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep connections alive
+    server: "KeycloakStub"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        with self.server.lock:
+            self.server.requests += 1
+            count = self.server.requests
+        time.sleep(self.server.delay)
+        body = json.dumps(
+            {"expires_in": self.server.expires_in, "access_token": f"token{count}"}
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class KeycloakStub(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), KeycloakStubHandler)
+        self.lock = Lock()
+        self.connections = 0
+        self.requests = 0
+        self.expires_in = 300
+        self.delay = 0.0
+
+    def handle_error(self, request, client_address):
+        pass  # Clients timing out break the pipe
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}/auth"
+
+
+@pytest.fixture
+def keycloak_stub():
+    server = KeycloakStub()
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
 def test_init(monkeypatch):
     monkeypatch.setenv("SAML_TOKEN", "test token")
     with pytest.deprecated_call():
@@ -73,7 +139,7 @@ def test_fetch_keycloak(t_delta: timedelta):
 
     with MonkeyPatch.context() as m:
         m.setenv("CLIENT_SECRET", "test secret")
-        m.setattr(requests, "post", mock_post)
+        m.setattr(requests.Session, "post", mock_post)
         settings = TokenSettings()
         settings._fetch_keycloak_token()
 
@@ -89,7 +155,7 @@ def test_fetch_keycloak_errors(monkeypatch):
         )
 
     monkeypatch.delenv("CLIENT_SECRET", raising=False)
-    monkeypatch.setattr(requests, "post", mock_post)
+    monkeypatch.setattr(requests.Session, "post", mock_post)
     settings = TokenSettings()
     with pytest.raises(AuthError, match="No client secret given"):
         settings._fetch_keycloak_token()
@@ -97,7 +163,6 @@ def test_fetch_keycloak_errors(monkeypatch):
     # Set a client secret
     monkeypatch.setenv("CLIENT_SECRET", "test secret")
     settings = TokenSettings()
-    settings._fetch_keycloak_token.cache_clear()
     with pytest.raises(AuthError, match=f"Failed to get Keycloak token: {fail_msg}"):
         settings._fetch_keycloak_token()
 
@@ -112,7 +177,7 @@ def test_fetch_bearer(t_delta: timedelta):
 
     with MonkeyPatch.context() as m:
         m.setenv("CLIENT_SECRET", "test secret")
-        m.setattr(requests, "post", mock_post)
+        m.setattr(requests.Session, "post", mock_post)
         settings = TokenSettings()
         assert settings._fetch_bearer()
 
@@ -192,3 +257,272 @@ def test_force_token_renewal(monkeypatch, mocker):
     settings._fetch_bearer(force=True, logger=logger)
 
     spy.assert_called_once()
+
+
+def test_session_reuses_connections(monkeypatch, keycloak_stub):
+    monkeypatch.setenv("CLIENT_SECRET", "test secret")
+    settings = TokenSettings(auth_server=keycloak_stub.url)
+    assert settings._fetch_bearer() == "Bearer token1"
+    assert settings._fetch_bearer(force=True) == "Bearer token2"
+    assert settings._fetch_bearer(force=True) == "Bearer token3"
+    assert keycloak_stub.requests == 3
+    assert keycloak_stub.connections == 1
+
+    session = requests.Session()
+    settings = TokenSettings(auth_server=keycloak_stub.url, session=session)
+    assert settings.session is session
+    assert settings == TokenSettings(auth_server=keycloak_stub.url)
+
+
+def test_auth_timeout(monkeypatch, keycloak_stub):
+    monkeypatch.setenv("CLIENT_SECRET", "test secret")
+    keycloak_stub.delay = 0.5
+    settings = TokenSettings(auth_server=keycloak_stub.url, auth_timeout=0.1)
+    with pytest.raises(AuthError, match="Failed to get Keycloak token"):
+        settings._fetch_keycloak_token()
+
+
+def test_refresh_ahead(monkeypatch, keycloak_stub):
+    monkeypatch.setenv("CLIENT_SECRET", "test secret")
+    keycloak_stub.expires_in = 4
+    settings = TokenSettings(
+        auth_server=keycloak_stub.url,
+        oidc_token_lifespan_offset=1,
+        oidc_token_refresh_ahead=2,
+    )
+    assert settings.get_headers()["Authorization"] == "Bearer token1"
+    assert keycloak_stub.requests == 1
+
+    # Renewed in the background after a second, instead of inline after three
+    time.sleep(1.5)
+    assert keycloak_stub.requests == 2
+    assert settings.get_headers()["Authorization"] == "Bearer token2"
+    assert keycloak_stub.requests == 2
+
+    settings.close()
+    time.sleep(1)
+    assert keycloak_stub.requests == 2
+
+
+def test_refresh_ahead_stopped(monkeypatch, keycloak_stub):
+    monkeypatch.setenv("CLIENT_SECRET", "test secret")
+    keycloak_stub.expires_in = 3
+    kwargs = dict(
+        auth_server=keycloak_stub.url,
+        oidc_token_lifespan_offset=1,
+        oidc_token_refresh_ahead=1.5,
+    )
+
+    # Renewal stops on leaving the context
+    with TokenSettings(**kwargs) as settings:
+        assert settings.get_headers()["Authorization"] == "Bearer token1"
+        timer = settings._state.refresh_timer
+        assert timer is not None
+    timer.join(1)
+    assert not timer.is_alive()
+
+    # Renewal stops once the settings are garbage collected
+    settings = TokenSettings(**kwargs)
+    assert settings.get_headers()["Authorization"] == "Bearer token2"
+    timer = settings._state.refresh_timer
+    del settings
+    gc.collect()
+    timer.join(1)
+    assert not timer.is_alive()
+    assert keycloak_stub.requests == 2
+
+
+def test_refresh_ahead_error(monkeypatch):
+    def fetch_keycloak_token(self):
+        raise KeyError("access_token")
+
+    monkeypatch.setenv("CLIENT_SECRET", "test secret")
+    monkeypatch.setattr(TokenSettings, "_fetch_keycloak_token", fetch_keycloak_token)
+    settings = TokenSettings(oidc_token_refresh_ahead=1)
+    settings._state.refresh_timer = Timer(0, settings._refresh)
+    settings._refresh()
+
+    # The failed renewal is scheduled again on the next use
+    assert settings._state.refresh_timer is None
+
+
+def test_refresh_ahead_disabled(monkeypatch, keycloak_stub):
+    monkeypatch.setenv("CLIENT_SECRET", "test secret")
+    keycloak_stub.expires_in = 2
+    settings = TokenSettings(
+        auth_server=keycloak_stub.url, oidc_token_lifespan_offset=1
+    )
+    assert settings.get_headers()["Authorization"] == "Bearer token1"
+    time.sleep(0.8)
+    assert keycloak_stub.requests == 1
+
+
+def test_aget_headers_single_flight(monkeypatch, keycloak_stub):
+    monkeypatch.setenv("CLIENT_SECRET", "test secret")
+    keycloak_stub.delay = 0.2
+    settings = TokenSettings(auth_server=keycloak_stub.url)
+
+    async def fetch_concurrently():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.ensure_future(tick())
+        headers = await asyncio.gather(*(settings.aget_headers() for _ in range(10)))
+        ticker.cancel()
+        return headers, ticks
+
+    headers, ticks = asyncio.run(fetch_concurrently())
+    assert headers == [{"Authorization": "Bearer token1"}] * 10
+    assert keycloak_stub.requests == 1
+    # The event-loop kept running during the refresh
+    assert ticks > 5
+
+    # Works from other event-loops too
+    headers = asyncio.run(settings.aget_headers(force=True))
+    assert headers == {"Authorization": "Bearer token2"}
+    assert keycloak_stub.requests == 2
+
+
+def test_aget_headers_valid_token(monkeypatch, keycloak_stub):
+    monkeypatch.setenv("CLIENT_SECRET", "test secret")
+    settings = TokenSettings(auth_server=keycloak_stub.url)
+    assert settings.get_headers() == {"Authorization": "Bearer token1"}
+
+    # A valid token is returned without a call on the thread pool
+    def fail(*args, **kwargs):
+        raise AssertionError("unexpected fetch")
+
+    monkeypatch.setattr(TokenSettings, "_fetch_bearer", fail)
+    headers = asyncio.run(settings.aget_headers())
+    assert headers == {"Authorization": "Bearer token1"}
+    assert settings._state.bearer_task is None
+    assert keycloak_stub.requests == 1
+
+
+def test_single_flight_renewal(monkeypatch, keycloak_stub):
+    monkeypatch.setenv("CLIENT_SECRET", "test secret")
+    keycloak_stub.expires_in = 0
+    settings = TokenSettings(auth_server=keycloak_stub.url)
+    assert settings._fetch_bearer() == "Bearer token2"  # Renewed as expired
+
+    # All threads wait for a single renewal of the expired token
+    keycloak_stub.expires_in = 300
+    keycloak_stub.delay = 0.2
+    barrier = Barrier(32)
+
+    def fetch_bearer(_):
+        barrier.wait()
+        return settings._fetch_bearer()
+
+    with ThreadPoolExecutor(32) as executor:
+        bearers = set(executor.map(fetch_bearer, range(32)))
+    assert bearers == {"Bearer token3"}
+    assert keycloak_stub.requests == 3
+
+
+def test_single_flight_renewal_valid_token(monkeypatch, keycloak_stub):
+    monkeypatch.setenv("CLIENT_SECRET", "test secret")
+    keycloak_stub.expires_in = 31
+    settings = TokenSettings(auth_server=keycloak_stub.url)
+    assert settings._fetch_bearer() == "Bearer token1"
+
+    # Threads keep using the still valid token, while one thread renews it
+    time.sleep(1.1)
+    keycloak_stub.delay = 1
+    barrier = Barrier(32)
+
+    def fetch_bearer(_):
+        barrier.wait()
+        start = time.monotonic()
+        bearer = settings._fetch_bearer()
+        return bearer, time.monotonic() - start
+
+    with ThreadPoolExecutor(32) as executor:
+        results = list(executor.map(fetch_bearer, range(32)))
+    assert keycloak_stub.requests == 2
+    waited = [bearer for bearer, elapsed in results if elapsed >= 0.5]
+    assert waited == ["Bearer token2"]
+    assert {bearer for bearer, _ in results} == {"Bearer token1", "Bearer token2"}
+
+
+def test_token_cache_dir(monkeypatch, keycloak_stub, tmp_path):
+    monkeypatch.setenv("CLIENT_SECRET", "test secret")
+    cache_dir = tmp_path / "tokens"
+    settings = TokenSettings(
+        auth_server=keycloak_stub.url, oidc_token_cache_dir=cache_dir
+    )
+    assert settings._fetch_bearer() == "Bearer token1"
+    (cache_file,) = cache_dir.iterdir()
+    assert stat.S_IMODE(cache_file.stat().st_mode) == 0o600
+    assert stat.S_IMODE(cache_dir.stat().st_mode) == 0o700
+
+    # New settings, as in another process, reuse the cached token
+    settings = TokenSettings(
+        auth_server=keycloak_stub.url, oidc_token_cache_dir=cache_dir
+    )
+    assert settings._fetch_bearer() == "Bearer token1"
+    assert keycloak_stub.requests == 1
+
+    # But not for other clients
+    settings = TokenSettings(
+        auth_server=keycloak_stub.url, oidc_token_cache_dir=cache_dir, client_id="os2"
+    )
+    assert settings._fetch_bearer() == "Bearer token2"
+    assert len(list(cache_dir.iterdir())) == 2
+
+    # Nor if readable by others
+    cache_file.chmod(0o644)
+    settings = TokenSettings(
+        auth_server=keycloak_stub.url, oidc_token_cache_dir=cache_dir
+    )
+    assert settings._fetch_bearer() == "Bearer token3"
+    assert stat.S_IMODE(cache_file.stat().st_mode) == 0o600
+
+
+def test_token_cache_dir_expired(monkeypatch, keycloak_stub, tmp_path):
+    monkeypatch.setenv("CLIENT_SECRET", "test secret")
+    keycloak_stub.expires_in = 31
+    settings = TokenSettings(
+        auth_server=keycloak_stub.url, oidc_token_cache_dir=tmp_path
+    )
+    assert settings._fetch_bearer() == "Bearer token1"
+
+    # Due for renewal, so not reused
+    time.sleep(1.1)
+    settings = TokenSettings(
+        auth_server=keycloak_stub.url, oidc_token_cache_dir=tmp_path
+    )
+    assert settings._fetch_bearer() == "Bearer token2"
+
+    # Corrupt cache files are ignored
+    (cache_file,) = tmp_path.iterdir()
+    cache_file.write_text("{")
+    settings = TokenSettings(
+        auth_server=keycloak_stub.url, oidc_token_cache_dir=tmp_path
+    )
+    assert settings._fetch_bearer() == "Bearer token3"
+    assert keycloak_stub.requests == 3
+
+
+def test_pickle_and_copy(monkeypatch, keycloak_stub):
+    monkeypatch.setenv("CLIENT_SECRET", "test secret")
+    settings = TokenSettings(auth_server=keycloak_stub.url)
+    assert settings._fetch_bearer() == "Bearer token1"
+
+    for duplicate in [
+        pickle.loads(pickle.dumps(settings)),
+        copy.deepcopy(settings),
+        settings.copy(deep=True),
+    ]:
+        assert duplicate == settings
+        # The token, and the lock guarding it, are not shared with duplicates
+        assert duplicate._state.token is None
+        assert duplicate._state.token_lock is not settings._state.token_lock
+
+    settings = settings.copy(update={"client_id": "os2"})
+    assert settings._fetch_bearer() == "Bearer token2"
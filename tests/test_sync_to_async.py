@@ -0,0 +1,101 @@
+# SPDX-FileCopyrightText: 2023 Magenta ApS <https://magenta.dk>
+# SPDX-License-Identifier: MPL-2.0
+import asyncio
+import threading
+from asyncio import iscoroutinefunction
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+
+import hypothesis.strategies as st
+import pytest
+from hypothesis import given
+
+from ra_utils.asyncio_utils import configure_shared_executor
+from ra_utils.asyncio_utils import shared_executor
+from ra_utils.sync_to_async import sync_to_async
+
+request_id: ContextVar[str] = ContextVar("request_id", default="")
+
+
+@sync_to_async
+def async_add(a: int, b: int) -> int:
+    return a + b
+
+
+def sync_add(a: int, b: int) -> int:
+    return a + b
+
+
+@given(st.integers(), st.integers())
+def test_add(a: int, b: int) -> None:
+    assert iscoroutinefunction(async_add)
+    assert not iscoroutinefunction(sync_add)
+    assert asyncio.run(async_add(a, b)) == a + b
+    assert asyncio.run(sync_to_async(sync_add)(a, b)) == a + b
+
+
+def thread_name() -> str:
+    return threading.current_thread().name
+
+
+async def test_runs_on_shared_executor() -> None:
+    assert (await sync_to_async(thread_name)()).startswith("ra_utils")
+
+    with ThreadPoolExecutor(thread_name_prefix="custom") as executor:
+        name = await sync_to_async(executor=executor)(thread_name)()
+        assert name.startswith("custom")
+
+
+async def test_configure_shared_executor() -> None:
+    try:
+        configure_shared_executor(2)
+        assert shared_executor()._max_workers == 2  # type: ignore
+        running = 0
+        max_running = 0
+        lock = threading.Lock()
+
+        @sync_to_async
+        def blocking() -> None:
+            nonlocal running, max_running
+            with lock:
+                running += 1
+                max_running = max(max_running, running)
+            threading.Event().wait(0.01)
+            with lock:
+                running -= 1
+
+        await asyncio.gather(*(blocking() for _ in range(10)))
+        assert max_running == 2
+    finally:
+        configure_shared_executor(None)
+
+    with pytest.raises(ValueError):
+        configure_shared_executor(0)
+
+
+async def test_contextvars() -> None:
+    @sync_to_async
+    def get_request_id() -> str:
+        return request_id.get()
+
+    request_id.set("abc")
+    assert await get_request_id() == "abc"
+
+
+async def test_cancellable() -> None:
+    started = threading.Event()
+    stopped = threading.Event()
+
+    @sync_to_async(cancellable=True)
+    def long_running(cancelled: threading.Event) -> None:
+        started.set()
+        assert cancelled.wait(timeout=5)
+        stopped.set()
+
+    task = asyncio.ensure_future(long_running())
+    await asyncio.get_running_loop().run_in_executor(None, started.wait)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    await asyncio.get_running_loop().run_in_executor(None, stopped.wait, 5)
+    assert stopped.is_set()
@@ -1,9 +1,20 @@
 # SPDX-FileCopyrightText: 2021 Magenta ApS <https://magenta.dk>
 # SPDX-License-Identifier: MPL-2.0
+import gc
+from asyncio import AbstractEventLoop
+from asyncio import get_running_loop
 from asyncio import iscoroutinefunction
 from asyncio import run
+from asyncio import sleep
+from concurrent.futures import ThreadPoolExecutor
+from inspect import isasyncgenfunction
 from inspect import isawaitable
+from typing import AsyncIterator
 from typing import Awaitable
+from typing import Generator
+from typing import Iterable
+from typing import List
+from typing import Set
 
 import hypothesis.strategies as st
 import pytest
@@ -63,6 +74,22 @@ def test_add(a: int, b: int):
     assert run(result4) == expected  # type: ignore
 
 
+class UvloopAdder(Syncable, AsyncAdder):
+    use_uvloop = True
+
+
+async def acall_uvloopadder(*args) -> int:
+    return await UvloopAdder().add(*args)
+
+
+def test_uvloop():
+    assert UvloopAdder().add(1, 2) == 3
+    # Instances in the same thread share one loop, rather than leaking one each
+    loop = UvloopAdder()._Syncable__loop  # type: ignore
+    assert UvloopAdder()._Syncable__loop is loop  # type: ignore
+    assert run(acall_uvloopadder(1, 2)) == 3
+
+
 class AsyncNoExitContext:
     def foo(self):
         return "bar"
@@ -146,3 +173,173 @@ def test_context():
     assert "__exit__" in str(excinfo)
 
     assert ContextNoExit().foo() == "bar"
+
+
+class AsyncStaticAdder(AsyncAdder):
+    @staticmethod
+    async def static_add(a: int, b: int) -> int:
+        return a + b
+
+    @classmethod
+    async def class_add(cls, a: int, b: int) -> int:
+        return a + b
+
+
+class StaticAdder(Syncable, AsyncStaticAdder):
+    pass
+
+
+class DoublingAdder(Adder):
+    async def add(self, a: int, b: int) -> int:
+        return 2 * (a + b)
+
+
+def test_wrappers_precomputed():
+    # Attribute access is not intercepted, coroutine functions are wrapped once
+    assert "__getattribute__" not in vars(Syncable)
+    adder = StaticAdder()
+    assert adder.add.__func__ is StaticAdder().add.__func__  # type: ignore
+    assert adder.add.__name__ == "add"
+    assert iscoroutinefunction(StaticAdder.static_add) is True
+
+    assert adder.add(1, 2) == 3  # type: ignore
+    assert adder.static_add(1, 2) == 3  # type: ignore
+    assert adder.class_add(1, 2) == 3  # type: ignore
+
+    # Overrides in subclasses are wrapped too
+    assert DoublingAdder().add(1, 2) == 6  # type: ignore
+
+
+class AsyncPooledClient:
+    def __init__(self) -> None:
+        self.loops: Set[AbstractEventLoop] = set()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def fetch(self, value: int) -> int:
+        self.loops.add(get_running_loop())
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await sleep(0.05)
+        self.in_flight -= 1
+        return value
+
+
+class PooledClient(Syncable, AsyncPooledClient):
+    threadsafe = True
+
+
+def test_threadsafe():
+    client = PooledClient()
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(client.fetch, range(16)))  # type: ignore
+    assert results == list(range(16))
+    # Every call ran on the one loop owned by the client, concurrently
+    assert len(client.loops) == 1
+    assert client.max_in_flight > 1
+    (loop,) = client.loops
+    assert loop.is_running()
+
+    async def from_another_loop(client: PooledClient) -> int:
+        return await client.fetch(5)
+
+    assert run(from_another_loop(client)) == 5
+    assert client.loops == {loop}
+
+    # The loop thread is stopped with the client
+    del client
+    gc.collect()
+    assert not loop.is_running()
+
+
+class AsyncPaginator:
+    def __init__(self) -> None:
+        self.fetched = 0
+        self.closed = False
+
+    async def pages(self, count: int) -> AsyncIterator[List[int]]:
+        try:
+            for page in range(count):
+                await sleep(0)
+                self.fetched += 1
+                yield [page] * 2
+        finally:
+            self.closed = True
+
+    async def __aiter__(self) -> AsyncIterator[int]:
+        async for page in self.pages(3):
+            for item in page:
+                yield item
+
+
+class Paginator(Syncable, AsyncPaginator):
+    pass
+
+
+class AsyncCountdown:
+    def __init__(self, start: int) -> None:
+        self.current = start
+
+    def __aiter__(self) -> "AsyncCountdown":
+        return self
+
+    async def __anext__(self) -> int:
+        if self.current == 0:
+            raise StopAsyncIteration
+        self.current -= 1
+        return self.current
+
+
+class Countdown(Syncable, AsyncCountdown):
+    pass
+
+
+class AsyncSequence:
+    def __getitem__(self, index: int) -> int:
+        if index == 3:
+            raise IndexError(index)
+        return index
+
+
+class Sequence(Syncable, AsyncSequence):
+    pass
+
+
+class ThreadsafePaginator(Syncable, AsyncPaginator):
+    threadsafe = True
+
+
+def test_async_generators():
+    assert isasyncgenfunction(Paginator.pages) is True
+
+    paginator = Paginator()
+    pages = paginator.pages(1000)  # type: ignore
+    assert isinstance(pages, Generator)
+    # Pages are fetched one at a time, and the generator closed on exit
+    assert next(pages) == [0, 0]
+    assert next(pages) == [1, 1]
+    assert paginator.fetched == 2
+    pages.close()
+    assert paginator.closed is True
+
+    assert list(Paginator()) == [0, 0, 1, 1, 2, 2]  # type: ignore
+    assert list(Countdown(3)) == [2, 1, 0]  # type: ignore
+    assert not isinstance(Adder(), Iterable)
+    with pytest.raises(TypeError):
+        iter(Adder())  # type: ignore
+    # Iteration of parents without `__aiter__` is left alone
+    assert list(iter(Sequence())) == [0, 1, 2]
+
+    async def acall_paginator() -> List[int]:
+        return [item async for item in Paginator()]
+
+    assert run(acall_paginator()) == [0, 0, 1, 1, 2, 2]
+
+    threadsafe_paginator = ThreadsafePaginator()
+    assert list(threadsafe_paginator.pages(2)) == [[0, 0], [1, 1]]  # type: ignore
+
+    async def acall_threadsafe_paginator() -> List[List[int]]:
+        pages = threadsafe_paginator.pages(2)  # type: ignore
+        return [page async for page in pages]
+
+    assert run(acall_threadsafe_paginator()) == [[0, 0], [1, 1]]